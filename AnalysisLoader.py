@@ -4,6 +4,8 @@ Input are the analysis folder path and raw data path(s).
 """
 
 
+import os.path
+import json
 import numpy as np
 from openpyxl import load_workbook
 
@@ -14,16 +16,24 @@ class RawDataLoader:
     """This class loads raw data."""
     def __init__(self, analysis_folder, fnames):
 
-        raw_data           =  LoadRawDataCzi.LoadRawDataCzi(fnames, analysis_folder)
-        first_slctd_frame  =  np.load(analysis_folder + '/first_slctd_frame.npy')
-        last_slctd_frame   =  np.load(analysis_folder + '/last_slctd_frame.npy')
-        jj_start           =  np.where(np.sum(raw_data.red_mip - first_slctd_frame, axis=(1, 2)) == 0)[0][0]
-        jj_end             =  np.where(np.sum(raw_data.red_mip - last_slctd_frame, axis=(1, 2)) == 0)[0][0]
-
-        raw_data.red_mip    =  raw_data.red_mip[jj_start:jj_end + 1]
-        raw_data.red        =  raw_data.red[jj_start:jj_end + 1]
-        raw_data.green_mip  =  raw_data.green_mip[jj_start:jj_end + 1]
-        raw_data.green      =  raw_data.green[jj_start:jj_end + 1]
+        if os.path.isfile(analysis_folder + '/manifest.json'):                                                  # the manifest gives files, frames and crop: decode only what was analysed
+            with open(analysis_folder + '/manifest.json') as f:
+                manifest  =  json.load(f)
+            if sorted(os.path.basename(fname) for fname in fnames) != sorted(manifest["files"]):
+                raise ValueError('Raw data files do not match the ones of the analysis: ' + ', '.join(manifest["files"]))
+            raw_data  =  LoadRawDataCzi.LoadRawDataCzi(fnames, analysis_folder, crop_roi=manifest["crop_roi"], z_range=manifest["z_range"], frames=manifest["frames"])
+
+        else:                                                                                                   # older analysis: load everything and find the frame range comparing mips
+            raw_data           =  LoadRawDataCzi.LoadRawDataCzi(fnames, analysis_folder)
+            first_slctd_frame  =  np.load(analysis_folder + '/first_slctd_frame.npy')
+            last_slctd_frame   =  np.load(analysis_folder + '/last_slctd_frame.npy')
+            jj_start           =  np.where(np.all(raw_data.red_mip == first_slctd_frame, axis=(1, 2)))[0][0]     # mip are unsigned integers: compare them instead of subtracting
+            jj_end             =  np.where(np.all(raw_data.red_mip == last_slctd_frame, axis=(1, 2)))[0][0]
+
+            raw_data.red_mip    =  raw_data.red_mip[jj_start:jj_end + 1]
+            raw_data.red        =  raw_data.red[jj_start:jj_end + 1]
+            raw_data.green_mip  =  raw_data.green_mip[jj_start:jj_end + 1]
+            raw_data.green      =  raw_data.green[jj_start:jj_end + 1]
 
         self.green            =  raw_data.green
         self.red              =  raw_data.red
@@ -32,4 +42,8 @@ class RawDataLoader:
         self.pix_size_xy      =  raw_data.pix_size_xy
         self.pix_size_z       =  raw_data.pix_size_z
         self.time_step_value  =  raw_data.time_step_value
-        self.chs_red_green    =  np.load(analysis_folder + '/chs_red_green.npy')
\ No newline at end of file
+        self.chs_red_green    =  np.load(analysis_folder + '/chs_red_green.npy')
+        self.crop_roi         =  raw_data.crop_roi
+        self.z_range          =  raw_data.z_range
+        self.fnames           =  raw_data.fnames
+        self.files_tlen       =  raw_data.files_tlen
\ No newline at end of file
@@ -4,6 +4,8 @@ Input are the matrix of segmented and tracked nuclei and raw data in 2 channels.
 For each of the tracked nucleus, the function writes an Excel file with the intensity in both channels.
 """
 
+import os.path
+import json
 import datetime
 import time
 import numpy as np
@@ -11,11 +13,12 @@ import xlsxwriter
 from skimage.measure import regionprops_table
 
 import ServiceWidgets
+import TrackTable
 
 
 class AnalysisSaver:
     """Only class, does all the job."""
-    def __init__(self, nucs_segm, nucs_trck, raw_data, folder2write, chs_red_green, soft_version, fname4journal):
+    def __init__(self, nucs_segm, nucs_trck, raw_data, folder2write, chs_red_green, soft_version, fname4journal, tracks=None):
 
         nucs_tags  =  np.unique(nucs_trck[nucs_trck != 0])                      # check tracked nuclei tags
         tlen       =  nucs_trck.shape[0]                                        # number of time steps
@@ -93,6 +96,16 @@ class AnalysisSaver:
 
         workbook.close()
 
+        manifest  =  {"software_version": soft_version,                                                           # everything needed to reload exactly the analysed raw data
+                      "files": [os.path.basename(fname) for fname in raw_data.fnames],
+                      "files_tlen": [int(tlen_file) for tlen_file in raw_data.files_tlen],
+                      "frames": [int(frame) for frame in raw_data.red.frames],
+                      "chs_red_green": [int(ch) for ch in chs_red_green],
+                      "crop_roi": [int(k) for k in raw_data.crop_roi],
+                      "z_range": [int(k) for k in raw_data.z_range]}
+        with open(folder2write + '/manifest.json', 'w') as f:
+            json.dump(manifest, f, indent=4)
+
         np.save(folder2write + '/first_slctd_frame.npy', raw_data.red_mip[0])
         np.save(folder2write + '/last_slctd_frame.npy', raw_data.red_mip[-1])
         np.save(folder2write + '/nucs_segm.npy', nucs_segm)
@@ -101,6 +114,10 @@ class AnalysisSaver:
         np.save(folder2write +  '/red_ints_vol.npy', red_ints_vol)
         np.save(folder2write +  '/green_ints_vol.npy', green_ints_vol)
 
+        if tracks is None:                                                                                      # table of the tracked nuclei not given by the tracker (older analysis)
+            tracks  =  TrackTable.build_table(nucs_trck, nucs_segm, raw_data.pix_size_xy, raw_data.pix_size_z)
+        TrackTable.save_table(folder2write, *tracks)
+
 
 class ShowTraces:
     """Collect intensity and volume of a tracked 3D nucleus."""
@@ -0,0 +1,93 @@
+"""This function decodes the planes of czi files directly from their subblocks.
+
+Each subblock of a czi time series is a single (t, z, c) plane (or a tile of it if
+the acquisition is a mosaic): the subblock directories of all the files are indexed
+once, then planes of all the channels and all the files are decompressed in a
+single pass over a pool of threads (decompression and file reading release the GIL).
+"""
+
+
+import multiprocessing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import czifile
+
+
+class CziDecoder:
+    """Index the subblocks of a list of czi files and decode them as (x, y) planes of the whole movie."""
+    def __init__(self, fnames, max_workers=None):
+
+        czis       =  []
+        planes     =  dict()                                                    # (t, z, c) in the whole movie -> list of (subblock directory entry, y and x position and size)
+        t_offsets  =  [0]                                                       # index of the first frame of each file in the whole movie
+        for fname in fnames:
+            czi           =  czifile.CziFile(str(fname))
+            czi._fh.lock  =  True                                               # the file handle is shared by the threads: reads must be locked
+            czi_start     =  dict(zip(czi.axes, czi.start))
+            czi_shape     =  dict(zip(czi.axes, czi.shape))
+            if czis and (czi_shape.get('Z', 1), czi_shape['X'], czi_shape['Y']) != (zlen, xlen, ylen):
+                raise ValueError('Files have different Z, X or Y sizes and cannot be concatenated')
+            zlen, xlen, ylen  =  czi_shape.get('Z', 1), czi_shape['X'], czi_shape['Y']
+
+            for entry in czi.filtered_subblock_directory:
+                idx  =  {dim: start - czi_start[dim] for dim, start in zip(entry.axes, entry.start)}       # position of the subblock with respect to the origin of the file
+                if any(idx[dim] != 0 for dim in idx if dim not in 'TCZMYX0'):                          # work on the first scene / view / phase only (mosaic tiles, M, are placed by their Y and X start)
+                    continue
+                if entry.stored_shape != entry.shape:                                                   # skip downsampled (pyramid) copies of the planes
+                    continue
+                key  =  (t_offsets[-1] + idx.get('T', 0), idx.get('Z', 0), idx.get('C', 0))
+                size  =  dict(zip(entry.axes, entry.shape))
+                planes.setdefault(key, []).append((entry, idx['Y'], idx['X'], size['Y'], size['X']))
+
+            czis.append(czi)
+            t_offsets.append(t_offsets[-1] + czi_shape.get('T', 1))
+
+        self.czis         =  czis
+        self.planes       =  planes
+        self.t_offsets    =  np.asarray(t_offsets)
+        self.shape        =  (t_offsets[-1], zlen, xlen, ylen)                  # shape of a single channel of the whole movie (t, z, x, y)
+        self.dtype        =  np.result_type(*[czi.dtype for czi in czis])
+        self.max_workers  =  max_workers if max_workers is not None else multiprocessing.cpu_count()
+
+    def read_plane(self, tt, zz, ch, crop_roi=None):
+        """Decode the (x, y) plane of channel ch at time tt (index in the whole movie) and depth zz.
+
+        With crop_roi ([x0, y0, x1, y1]) only that region is given back, and tiles outside of it are not decoded.
+        """
+        x0, y0, x1, y1  =  crop_roi if crop_roi is not None else (0, 0, self.shape[2], self.shape[3])
+        plane           =  np.zeros((y1 - y0, x1 - x0), dtype=self.dtype)      # subblocks are (y, x) ordered
+        for entry, ty0, tx0, ysize, xsize in self.planes[(tt, zz, ch)]:
+            iy0, iy1  =  max(ty0, y0), min(ty0 + ysize, y1)                     # intersection of the tile with the crop
+            ix0, ix1  =  max(tx0, x0), min(tx0 + xsize, x1)
+            if iy0 >= iy1 or ix0 >= ix1:
+                continue
+            tile                                             =  entry.data_segment().data().reshape(ysize, xsize)
+            plane[iy0 - y0:iy1 - y0, ix0 - x0:ix1 - x0]  =  tile[iy0 - ty0:iy1 - ty0, ix0 - tx0:ix1 - tx0]
+        return plane.T                                                          # planes in the software are (x, y) ordered
+
+    def decode_planes(self, keys, crop_roi=None):
+        """Decode the list of (t, z, c) planes in parallel, yielding (key, plane) in the same order of keys."""
+        with ThreadPoolExecutor(self.max_workers) as executor:
+            futures  =  deque()                                                 # planes being decoded: a bounded queue, so that memory does not grow with the movie size
+            for key in keys:
+                futures.append((key, executor.submit(self.read_plane, *key, crop_roi)))
+                if len(futures) >= 4 * self.max_workers:
+                    key_bff, future  =  futures.popleft()
+                    yield key_bff, future.result()
+            while futures:
+                key_bff, future  =  futures.popleft()
+                yield key_bff, future.result()
+
+    def mip_preview(self, tt=0):
+        """Maximum intensity projection of a single time frame, over z and over all the channels (to choose a crop)."""
+        chs      =  sorted(set(key[2] for key in self.planes))
+        preview  =  np.zeros(self.shape[2:], dtype=self.dtype)
+        for key, plane in self.decode_planes([(tt, z, ch) for z in range(self.shape[1]) for ch in chs]):
+            np.maximum(preview, plane, out=preview)
+        return preview
+
+    def close(self):
+        """Close all the files."""
+        for czi in self.czis:
+            czi.close()
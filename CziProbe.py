@@ -0,0 +1,81 @@
+"""This function reads the metadata of czi files without touching pixel data.
+
+Output are sizes (t, z, x, y) of each file, channel names, pixel sizes, time step and
+an estimation of the memory needed by the data. Metadata of each file are read only
+once and kept in memory (a file is identified by path, size and modification time).
+"""
+
+
+import os
+import xml.etree.ElementTree as ET
+import numpy as np
+import czifile
+
+
+PROBES_CACHE  =  dict()                                                         # (path, size, modification time) -> metadata of the file
+
+
+def probe_file(fname):
+    """Read the metadata of a single czi file: subblocks directory, xml metadata and time stamps."""
+    stat  =  os.stat(fname)
+    key   =  (os.path.abspath(fname), stat.st_size, stat.st_mtime_ns)
+    if key in PROBES_CACHE:
+        return PROBES_CACHE[key]
+
+    with czifile.CziFile(str(fname)) as czi:
+        czi_shape  =  dict(zip(czi.axes, czi.shape))
+        shape      =  (czi_shape.get('T', 1), czi_shape.get('Z', 1), czi_shape['X'], czi_shape['Y'])     # software order (t, z, x, y)
+        dtype      =  czi.dtype
+        metadata   =  ET.fromstring(czi.metadata(raw=True))
+
+        timestamps  =  np.zeros(0)
+        for attachment in czi.attachments():
+            if attachment.attachment_entry.name == 'TimeStamps':
+                timestamps  =  attachment.data()
+                break
+
+    pix_sizes  =  dict()
+    for distance in metadata.findall('.//Scaling/Items/Distance'):              # pixel sizes of the image (other blocks have Distance elements too), stored in meters
+        value  =  distance.find('Value')
+        if value is not None and value.text:
+            pix_sizes[distance.get('Id')]  =  float(value.text) * 1e6
+
+    channels       =  metadata.find('.//Information/Image/Dimensions/Channels')  # channels of the image, in order (other blocks list channels too)
+    channel_names  =  [channel.get('Name', channel.get('Id')) for channel in channels.findall('Channel')] if channels is not None else []
+    if len(channel_names) != czi_shape.get('C', 1):                            # names not found in the metadata
+        channel_names  =  ["Ch" + str(k + 1) for k in range(czi_shape.get('C', 1))]
+
+    PROBES_CACHE[key]  =  {"shape": shape, "dtype": dtype, "pix_size_xy": pix_sizes.get('X'), "pix_size_z": pix_sizes.get('Z'), "channel_names": channel_names, "timestamps": timestamps}
+    return PROBES_CACHE[key]
+
+
+class CziProbe:
+    """Only class, does all the job."""
+    def __init__(self, fnames):
+
+        probes  =  [probe_file(fname) for fname in fnames]
+
+        time_step_value  =  0
+        for probe in probes:                                                    # take into account that some files can have only 1 time frame
+            if probe["timestamps"].size > 1:
+                time_step_value  =  np.round(probe["timestamps"][1] - probe["timestamps"][0], 2)
+                break
+
+        shapes  =  [probe["shape"] for probe in probes]
+        dtype   =  np.result_type(*[probe["dtype"] for probe in probes])
+        tlen    =  sum(shape[0] for shape in shapes)
+
+        self.fnames           =  fnames
+        self.shapes           =  shapes                                         # (t, z, x, y) of each file
+        self.tlen             =  tlen
+        self.dtype            =  dtype
+        self.channel_names    =  probes[0]["channel_names"]
+        self.pix_size_xy      =  probes[0]["pix_size_xy"]                       # None if not in the metadata
+        self.pix_size_z       =  probes[0]["pix_size_z"]
+        self.time_step_value  =  time_step_value
+        self.mip_nbytes       =  2 * dtype.itemsize * tlen * shapes[0][2] * shapes[0][3]                    # memory needed by the mips of both channels
+        self.nbytes           =  self.mip_nbytes * shapes[0][1]                                             # memory needed by the 4D data of both channels
+
+    def summary(self):
+        """Short text with sizes and memory estimation."""
+        return "{} files; T={} Z={} X={} Y={}; raw data {:.2f} GB, mips {:.2f} GB".format(len(self.fnames), self.tlen, *self.shapes[0][1:], self.nbytes / 1024 ** 3, self.mip_nbytes / 1024 ** 3)
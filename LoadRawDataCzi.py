@@ -1,100 +1,215 @@
 """This function loads raw data files and gives as output the matrix video of the 4D raw data
 and the MIP of them, plus some metadata.
 
+The 4D raw data are not kept in memory: each channel is a LazyChannel that decodes
+the (t, z) planes only when they are requested and keeps the last ones in a bounded cache.
 This function assumes that there are not going to be singgle time frame files.
 """
 
 
+import threading
+from collections import OrderedDict
 import numpy as np
-from aicsimageio import AICSImage
-import czifile
 from natsort import natsorted
 
 import ServiceWidgets
+import CziDecoder
+import CziProbe
+import RawDataCache
+
+
+CACHE_BYTES  =  2 * 1024 ** 3                                                   # memory budget (bytes) of the decoded planes cache of each channel
+
+
+class PlanesCache:
+    """Least recently used cache of decoded planes, bounded in number of planes."""
+    def __init__(self, max_planes):
+
+        self.max_planes  =  max(1, int(max_planes))
+        self.planes      =  OrderedDict()
+        self.lock        =  threading.Lock()
+
+    def get(self, key):
+        """Return the cached plane (None if missing) and mark it as recently used."""
+        with self.lock:
+            plane  =  self.planes.get(key)
+            if plane is not None:
+                self.planes.move_to_end(key)
+            return plane
+
+    def put(self, key, plane):
+        """Add a plane to the cache, dropping the least recently used ones if it is full."""
+        with self.lock:
+            self.planes[key]  =  plane
+            self.planes.move_to_end(key)
+            while len(self.planes) > self.max_planes:
+                self.planes.popitem(last=False)
+
+
+class LazyChannel:
+    """Single channel 4D (t, z, x, y) matrix whose planes are decoded on demand.
+
+    Indexing with [t] gives the z-stack of a time frame, [t, z] a single plane; slicing
+    on time only (as in [t1:t2]) gives a new LazyChannel sharing decoder and cache.
+    """
+    def __init__(self, read_plane, shape, dtype, frames=None, cache=None):
+
+        plane_nbytes     =  np.dtype(dtype).itemsize * shape[2] * shape[3]
+        self.read_plane  =  read_plane                                                              # function (t, z) -> (x, y) plane, t is the time index in the whole movie
+        self.frames      =  np.arange(shape[0]) if frames is None else np.asarray(frames)           # time indexes (in the whole movie) of the frames of this channel
+        self.shape       =  (self.frames.size,) + tuple(shape[1:])
+        self.ndim        =  4
+        self.dtype       =  np.dtype(dtype)
+        self.cache       =  cache if cache is not None else PlanesCache(max(shape[1], CACHE_BYTES // plane_nbytes))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def plane(self, tt, zz):
+        """Return the (x, y) plane at time tt (index in the whole movie) and depth zz."""
+        plane  =  self.cache.get((tt, zz))
+        if plane is None:
+            plane                  =  np.asarray(self.read_plane(tt, zz), dtype=self.dtype)
+            plane.flags.writeable  =  False                                                         # cached planes are shared: protect them
+            self.cache.put((tt, zz), plane)
+        return plane
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key  =  (key,)
+        t_key, z_key, xy_key  =  key[0], key[1] if len(key) > 1 else slice(None), key[2:]
+
+        if isinstance(t_key, (int, np.integer)):
+            tt  =  self.frames[t_key]
+            if isinstance(z_key, (int, np.integer)):
+                return self.plane(tt, range(self.shape[1])[z_key])[xy_key]
+            stack  =  np.stack([self.plane(tt, zz) for zz in range(self.shape[1])[z_key]])
+            return stack[(slice(None),) + xy_key]
+
+        frames  =  self.frames[t_key]                                                               # slicing on time gives another lazy channel
+        sub     =  LazyChannel(self.read_plane, (frames.size,) + self.shape[1:], self.dtype, frames=frames, cache=self.cache)
+        if len(key) == 1:
+            return sub
+        return np.asarray(sub)[(slice(None),) + key[1:]]
+
+    def __array__(self, dtype=None, copy=None):
+        out  =  np.zeros(self.shape, dtype=self.dtype)                                              # decode everything (to use only when really needed)
+        for tt in range(self.shape[0]):
+            out[tt]  =  self[tt]
+        return out if dtype is None else out.astype(dtype)
+
+
+def load_order(fnames):
+    """Files in the order they are concatenated: natural order of the names."""
+    return natsorted(fnames, key=lambda y: y.lower())
 
 
 class LoadRawDataCzi:
-    """Only function, does all the job. """
-    def __init__(self, fnames, analysis_folder=None):
-
-        fnames           =  natsorted(fnames, key=lambda y: y.lower())                  # natural order for file names
-        time_step_value  =  0
-        j                =  0
-        while time_step_value == 0:                                                     # take into account that the first file can have only 1 time frame
-            with czifile.CziFile(str(fnames[j])) as czi:
-                for attachment in czi.attachments():
-                    if attachment.attachment_entry.name == 'TimeStamps':
-                        timestamps = attachment.data()
-                        break
-                else:
-                    raise ValueError('TimeStamps not found')
-
-            try:
-                time_step_value  =  np.round(timestamps[1] - timestamps[0], 2)  # time step value
-            except IndexError:
-                pass
-            j  +=  1
-
-        raw  =  AICSImage(fnames[0])                                                            # read and load file
-        try:
-            pix_size_xy  =  raw.physical_pixel_sizes.X
-            pix_size_z   =  raw.physical_pixel_sizes.Z
-
-        except:
+    """Only function, does all the job.
+
+    With use_cache, decoded files are stored in (and read back from) the on disk raw data cache.
+    crop_roi ([x0, y0, x1, y1]) and z_range ([z0, z1], z1 excluded) restrict the decoding to a subvolume,
+    frames (indexes in the concatenated movie) to some time frames.
+    """
+    def __init__(self, fnames, analysis_folder=None, use_cache=True, crop_roi=None, z_range=None, frames=None):
+
+        fnames  =  load_order(fnames)                                                   # natural order for file names
+        probe   =  CziProbe.CziProbe(fnames)                                            # all the metadata, without touching pixels
+
+        pix_size_xy, pix_size_z  =  probe.pix_size_xy, probe.pix_size_z
+        if pix_size_xy is None or pix_size_z is None:
             pix_size_xy, pix_size_z  =  ServiceWidgets.InputPixSize.get_vals()
 
         if analysis_folder is None:
-            chs_red_green  =  ServiceWidgets.SetColorChannel.getChannels(raw.channel_names)
+            chs_red_green  =  ServiceWidgets.SetColorChannel.getChannels(probe.channel_names)
         else:
             chs_red_green  =  np.load(analysis_folder + '/chs_red_green.npy')
-        red    =  raw.get_image_data("TZXY", C=chs_red_green[0])
-        green  =  raw.get_image_data("TZXY", C=chs_red_green[1])
-
-        tlen, zlen, xlen, ylen  =  raw.dims.T, raw.dims.Z, raw.dims.X, raw.dims.Y
-
-        green_mip  =  np.zeros((tlen, xlen, ylen))
-        red_mip    =  np.zeros((tlen, xlen, ylen))
-
-        pbar  =  ServiceWidgets.ProgressBar(total1=tlen)
-        pbar.show()
-
-        for t in range(tlen):                                                # maximum intensity projection
-            pbar.update_progressbar1(t)
-            for x in range(xlen):
-                red_mip[t, x, :]    =  red[t, :, x, :].max(0)
-                green_mip[t, x, :]  =  green[t, :, x, :].max(0)
-
-        pbar.close()
-
-        if len(fnames) > 1:
-            for fname in fnames[1:]:
-                raw_bff    =  AICSImage(fname)  # read and load file
-                red_bff    =  raw_bff.get_image_data("TZXY", C=chs_red_green[0])
-                green_bff  =  raw_bff.get_image_data("TZXY", C=chs_red_green[1])
-
-                tlen           =  raw_bff.dims.T
-                red            =  np.concatenate((red, red_bff), axis=0)
-                green          =  np.concatenate((green, green_bff), axis=0)
-                green_bff_mip  =  np.zeros((tlen, xlen, ylen))
-                red_bff_mip    =  np.zeros((tlen, xlen, ylen))
-
-                pbar  =  ServiceWidgets.ProgressBar(total1=tlen)
-                pbar.show()
-                for t in range(tlen):                                                # maximum intensity projection
-                    pbar.update_progressbar1(t)
-                    for x in range(xlen):
-                        red_bff_mip[t, x, :]    =  red_bff[t, :, x, :].max(0)
-                        green_bff_mip[t, x, :]  =  green_bff[t, :, x, :].max(0)
 
-                red_mip    =  np.concatenate((red_mip, red_bff_mip), axis=0)
-                green_mip  =  np.concatenate((green_mip, green_bff_mip), axis=0)
-                pbar.close()
+        for shape in probe.shapes[1:]:                                                          # outputs are allocated once: all the files must have the same z-stack
+            if shape[1:] != probe.shapes[0][1:]:
+                raise ValueError('Files have different Z, X or Y sizes and cannot be concatenated')
+
+        crop_roi  =  [0, 0, probe.shapes[0][2], probe.shapes[0][3]] if crop_roi is None else [int(k) for k in crop_roi]
+        z_range   =  [0, probe.shapes[0][1]] if z_range is None else [int(k) for k in z_range]
+        crop      =  crop_roi + z_range                                                         # cached data are cropped as well
+        shapes    =  [(shape[0], z_range[1] - z_range[0], crop_roi[2] - crop_roi[0], crop_roi[3] - crop_roi[1]) for shape in probe.shapes]     # (t, z, x, y) shape of each (cropped) file
+
+        t_offsets               =  np.cumsum([0] + [shape[0] for shape in shapes])             # index of the first frame of each file in the whole movie
+        tlen, zlen, xlen, ylen  =  (t_offsets[-1],) + tuple(shapes[0][1:])
+        dtype                   =  probe.dtype
+        frames                  =  np.arange(tlen) if frames is None else np.sort(np.asarray(frames, dtype=np.int64))             # frames to load (indexes in the whole movie)
+        file_frames             =  [frames[(frames >= t_offsets[jj]) & (frames < t_offsets[jj + 1])] - t_offsets[jj] for jj in range(len(fnames))]      # frames to load of each file (indexes in the file)
+
+        cache_entries  =  [RawDataCache.load_entry(fname, chs_red_green, crop) if use_cache and file_frames[jj].size > 0 else None for jj, fname in enumerate(fnames)]   # files already decoded are memory-mapped from the cache
+        missing        =  [jj for jj, entry in enumerate(cache_entries) if entry is None and file_frames[jj].size > 0]                                             # files to decode (files without selected frames are not touched)
+        decoder        =  CziDecoder.CziDecoder([fnames[jj] for jj in missing]) if missing else None                                                              # index the subblocks of the files to decode: sizes are read from metadata only
+
+        red_mip    =  np.zeros((frames.size, xlen, ylen), dtype=dtype)                         # keep the native dtype of the data (uint16)
+        green_mip  =  np.zeros((frames.size, xlen, ylen), dtype=dtype)
+
+        for jj, entry in enumerate(cache_entries):                                              # mips of the cached files are just copied
+            if entry is not None:
+                slots             =  np.searchsorted(frames, t_offsets[jj] + file_frames[jj])
+                red_mip[slots]    =  entry["red_mip"][file_frames[jj]]
+                green_mip[slots]  =  entry["green_mip"][file_frames[jj]]
+
+        if decoder is not None:
+            pbar  =  ServiceWidgets.ProgressBar(total1=frames.size)
+            pbar.show()
+
+            keep         =  [RawDataCache.entry_folder(fnames[jj], chs_red_green, crop) for jj, entry in enumerate(cache_entries) if entry is not None]     # entries in use by this load are never evicted
+            new_entries  =  []                                                                  # decoded files are written in the cache while decoding (only if they are decoded entirely and fit in the cache)
+            for jj in missing:
+                entry  =  RawDataCache.new_entry(fnames[jj], chs_red_green, shapes[jj], dtype, crop, keep) if use_cache and file_frames[jj].size == shapes[jj][0] else None
+                if entry is not None:
+                    keep.append(entry["folder"])
+                new_entries.append(entry)
+            colors       =  dict()                                                              # channel -> colors to build with it (red and green can be the same channel)
+            colors.setdefault(chs_red_green[0], []).append("red")
+            colors.setdefault(chs_red_green[1], []).append("green")
+            mips         =  {"red": red_mip, "green": green_mip}
+
+            keys  =  [(decoder.t_offsets[kk] + t, z, ch) for kk, jj in enumerate(missing) for t in file_frames[jj] for z in range(*z_range) for ch in colors]     # both channels of all the files are decoded in a single parallel pass, only selected frames and z range
+            for (t, z, ch), plane in decoder.decode_planes(keys, crop_roi):                     # maximum intensity projection, done while decoding: each plane is read once and reduced as it arrives
+                kk      =  np.searchsorted(decoder.t_offsets, t, side='right') - 1             # index of the file in the decoder
+                t_file  =  t - decoder.t_offsets[kk]                                           # time index in the file
+                slot    =  np.searchsorted(frames, t_offsets[missing[kk]] + t_file)            # position of the frame in the outputs
+                if z == z_range[0]:
+                    pbar.update_progressbar1(slot)
+                for color in colors[ch]:
+                    np.maximum(mips[color][slot], plane, out=mips[color][slot])
+                    if new_entries[kk] is not None:
+                        new_entries[kk][color][t_file, z - z_range[0]]  =  plane
+
+            for jj, entry in zip(missing, new_entries):
+                if entry is not None:
+                    slots                  =  np.searchsorted(frames, t_offsets[jj] + file_frames[jj])
+                    entry["red_mip"][:]    =  red_mip[slots]
+                    entry["green_mip"][:]  =  green_mip[slots]
+                    RawDataCache.close_entry(entry)
+                    cache_entries[jj]  =  RawDataCache.load_entry(fnames[jj], chs_red_green, crop)     # from now on the file is read from the cache
+            pbar.close()
+
+        def read_plane(tt, zz, color):
+            """Read a single (x, y) plane of the whole movie, from the cache or decoding it."""
+            jj  =  np.searchsorted(t_offsets, tt, side='right') - 1                             # file containing the frame
+            if cache_entries[jj] is not None:
+                return cache_entries[jj][color][tt - t_offsets[jj], zz]
+            kk  =  missing.index(jj)
+            return decoder.read_plane(decoder.t_offsets[kk] + tt - t_offsets[jj], z_range[0] + zz, chs_red_green[0 if color == "red" else 1], crop_roi)
+
+        red    =  LazyChannel(lambda tt, zz: read_plane(tt, zz, "red"), (tlen, zlen, xlen, ylen), dtype, frames=frames)
+        green  =  LazyChannel(lambda tt, zz: read_plane(tt, zz, "green"), (tlen, zlen, xlen, ylen), dtype, frames=frames)
 
         self.pix_size_xy      =  pix_size_xy
         self.pix_size_z       =  pix_size_z
-        self.time_step_value  =  time_step_value
+        self.time_step_value  =  probe.time_step_value
         self.red              =  red
         self.red_mip          =  red_mip
         self.green            =  green
         self.green_mip        =  green_mip
         self.chs_red_green    =  chs_red_green
+        self.crop_roi         =  crop_roi
+        self.z_range          =  z_range
+        self.fnames           =  fnames
+        self.files_tlen       =  [shape[0] for shape in shapes]
@@ -3,129 +3,341 @@
 Input is the 4D matrix of the segmented nuclei plus a threshold distance.
 """
 
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-from skimage.measure import regionprops_table
+from scipy.spatial import cKDTree
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.optimize import linear_sum_assignment
 from PyQt5 import QtWidgets
 
 import ServiceWidgets
+import RunCheckpoint
+import TrackTable
+import NucleiFeatures
 
 
-class Nuclei3dTracker:
-    """This class performs nuclei tracking in 3D."""
-    def __init__(self, nucs_segm, dist_thr, pix_size_XY, pix_size_Z):
+def frames_stats(nucs_segm, n_threads=1):
+    """Labels, volumes, centroids and bounding boxes of the nuclei of each frame (the stats the segmenter gives), measured with bincount, frames on a pool of n_threads threads."""
+    with ThreadPoolExecutor(n_threads) as executor:
+        return list(executor.map(lambda tt: NucleiFeatures.centroids_volumes(nucs_segm[tt]), range(nucs_segm.shape[0])))
+
+
+def frames_centroids(stats, scale):
+    """Labels and centroids of the nuclei of each frame from their stats; centroids (z, x, y) are multiplied by scale (pixel sizes, to have them in µm).
+
+    Results of all the frames are written in a single table.
+    """
+    bounds    =  np.cumsum([0] + [len(stat[0]) for stat in stats])                       # rows of each frame in the table
+    lbls_all  =  np.zeros(bounds[-1], dtype=np.int64)
+    ctrs_all  =  np.zeros((bounds[-1], 3))
+    for tt, (lbls, _, ctrs, _) in enumerate(stats):
+        lbls_all[bounds[tt]:bounds[tt + 1]]  =  lbls
+        ctrs_all[bounds[tt]:bounds[tt + 1]]  =  ctrs * scale
+    return [lbls_all[b0:b1] for b0, b1 in zip(bounds[:-1], bounds[1:])], [ctrs_all[b0:b1] for b0, b1 in zip(bounds[:-1], bounds[1:])]
+
+
+def write_tracks(nucs_segm, lbls, tracks, n_threads=1):
+    """Matrix of the tracked nuclei: each frame is relabelled with a look up table (segmented label -> track label) in a single pass, frames on a pool of n_threads threads."""
+    n_trcks    =  max([int(trk.max()) for trk in tracks if trk.size > 0] + [0])
+    nucs_trck  =  np.zeros(nucs_segm.shape, dtype=np.result_type(nucs_segm.dtype, np.min_scalar_type(n_trcks)))
+
+    def write_frame(tt):
+        """Relabel a single frame."""
+        lut            =  np.zeros(int(nucs_segm[tt].max()) + 1, dtype=nucs_trck.dtype)
+        lut[lbls[tt]]  =  tracks[tt]
+        np.take(lut, nucs_segm[tt], out=nucs_trck[tt])
+
+    with ThreadPoolExecutor(n_threads) as executor:
+        list(executor.map(write_frame, range(nucs_segm.shape[0])))
+    return nucs_trck
+
+
+def nearest_free(tree, consumed, ctr, dist_thr):
+    """Index of the nearest point of a kd-tree not consumed yet and closer than dist_thr to ctr (the smallest index among equally distant ones); None if there is no such point.
+
+    Neighbours are asked in growing numbers (k doubles), so that points already consumed around ctr are skipped without a scan of the whole frame.
+    """
+    kk  =  4
+    while tree.n > 0:
+        dists, idxs  =  tree.query(ctr, k=min(kk, tree.n), distance_upper_bound=dist_thr)
+        dists, idxs  =  np.atleast_1d(dists), np.atleast_1d(idxs)
+        close        =  dists < dist_thr                                                 # missing neighbours have infinite distance
+        free         =  close & ~consumed[np.minimum(idxs, tree.n - 1)]
+        exhausted    =  not close.all() or kk >= tree.n                                  # all the points closer than dist_thr have been seen
+        if free.any() and (exhausted or dists[free].min() < dists[-1]):                 # a point at the same distance could be further in the list
+            return idxs[free][dists[free] == dists[free].min()].min()
+        if exhausted:
+            return None
+        kk  *=  2
+    return None
+
 
-        nucs_trck   =  np.zeros_like(nucs_segm)                     # initialize output matrix of tracked nuclei
+def link_nearest(ctrs, dist_thr, pbar=None):
+    """Link the nuclei of all the frames: each nucleus not linked yet starts a new track, followed in the next frames by the nearest nucleus not linked yet closer than dist_thr to it, till a frame with no such nucleus.
 
-        tlen       =  nucs_segm.shape[0]                            # number of time frames
-        ctrs_mtx   =  np.squeeze(np.asarray(list(regionprops_table(nucs_segm[0], properties=["label", "centroid"]).values())))      # matrix of centroids: label, z, x, y. time is missing
-        ctrs_mtx   =  np.append(ctrs_mtx, np.zeros((ctrs_mtx.shape[1]))[None, :], 0)    # 5XN matrix: you have label, z, x, y, time as centroid coordinates for each nucleus. Here a column for time is add. It is all zeros since it is the first time frame
+    Nuclei are started in order of time and label. Each frame has its own kd-tree and nuclei already linked are marked in
+    a consumed mask, instead of removing them from a matrix of all the centroids. Give back the track label of each nucleus, frame by frame.
+    """
+    tlen      =  len(ctrs)
+    trees     =  [cKDTree(ctr) for ctr in ctrs]                                          # spatial index of each frame
+    consumed  =  [np.zeros(len(ctr), dtype=bool) for ctr in ctrs]
+    tracks    =  [np.zeros(len(ctr), dtype=np.int64) for ctr in ctrs]                    # track label of each nucleus
+    new_lbl   =  0                                                                       # new label is set to 0 since it is increased by 1
+    n_done    =  0
+    for tt in range(tlen):
+        if pbar is not None:
+            pbar.update_progressbar1(n_done)
+        n_done  +=  len(ctrs[tt])
+        for jj in np.where(~consumed[tt])[0]:                                           # nuclei not linked to a previous track (linking never touches the frame of the start)
+            new_lbl            +=  1                                                     # update label to assign
+            consumed[tt][jj]    =  True
+            tracks[tt][jj]      =  new_lbl
+            for uu in range(tt + 1, tlen):                                               # for all the following time frames
+                kk  =  nearest_free(trees[uu], consumed[uu], ctrs[tt][jj], dist_thr)    # distances are measured from the nucleus starting the track
+                if kk is None:
+                    break                                                                # no nucleus close enough: the track ends
+                consumed[uu][kk]  =  True
+                tracks[uu][kk]    =  new_lbl
+    return tracks
 
-        for tt in range(1, tlen):
-            ctrs_bff  =  np.squeeze(np.asarray(list(regionprops_table(nucs_segm[tt], properties=["label", "centroid"]).values())))   # extract label, z, x, y for the other time steps
-            ctrs_bff  =  np.append(ctrs_bff, tt * np.ones((ctrs_bff.shape[1]))[None, :], 0)                                          # add time to the matrix (now it is label, z, x, y, time)
-            ctrs_mtx  =  np.concatenate((ctrs_mtx, ctrs_bff), axis=1)                                                                # concatenate with hte previous
 
-        pbar      =  ServiceWidgets.ProgressBar(total1=ctrs_mtx.shape[1])
-        pbar_ref  =  ctrs_mtx.shape[1]
+class Nuclei3dTracker:
+    """This class performs nuclei tracking in 3D.
+
+    stats are the labels, volumes, centroids and bounding boxes of the nuclei of each frame given by the segmenter
+    (measured here if missing): they give the centroids to track and the table of the tracked nuclei.
+    """
+    def __init__(self, nucs_segm, dist_thr, pix_size_XY, pix_size_Z, n_threads=1, stats=None):
+
+        stats       =  stats if stats is not None else frames_stats(nucs_segm, n_threads)
+        lbls, ctrs  =  frames_centroids(stats, np.array([pix_size_Z, pix_size_XY, pix_size_XY]))      # centroids in µm, since xy and z pixel sizes are different
+
+        pbar  =  ServiceWidgets.ProgressBar(total1=sum(len(lbl) for lbl in lbls))
         pbar.update_progressbar1(0)
         pbar.show()
 
-        new_lbl  =  0                                                               # new label is set to 0 since it is increased by 1
-        while ctrs_mtx.shape[1] != 0:                                               # any time some coordinates are taken, they are removed from the matrix. Tracking is done when the ctrs_mtx matrix is empty                       
-            pbar.update_progressbar1(pbar_ref - ctrs_mtx.shape[1])
-            new_lbl  +=  1                                                          # update label to assign
-            ctrs_ref  =  ctrs_mtx[:, 0]                                             # take a new ref ctrs
-            ctrs_mtx  =  np.delete(ctrs_mtx, 0, axis=1)                       # delete the ref from the matrix
-            nucs_trck[int(ctrs_ref[-1])]  +=  ((nucs_segm[int(ctrs_ref[-1])]  ==  ctrs_ref[0]) * new_lbl).astype(np.uint16)   # add the corresponding nucleus to the new matrix
-            for uu in range(int(ctrs_ref[-1]) + 1, tlen):                           # for all the following time frames
-                ctrs_ext  =  ctrs_mtx[:, ctrs_mtx[4, :] == uu]                      # isolate the centroids with proper time frame 
-                distance  =  ctrs_ext - ctrs_ref[:, None] * np.ones_like(ctrs_ext)  # define a matrix to calculate the distance of the ref from all the centroids in the following frame
-                ppp       =  np.sqrt((distance[1, :] * pix_size_Z) ** 2 + (distance[2, :] * pix_size_XY) ** 2 + (distance[3, :] * pix_size_XY) ** 2)    # explicit distance calculation (it is in µm since we multiply for pixel size --xy and z are different)
-                # print(ppp.min())
-                if ppp.min() < dist_thr:                 # check distance is smaller than distance threshold
-                    ll                                =  np.argmin(ppp)                 # coordinate of the min of the distance 
-                    nucs_trck[int(ctrs_ext[-1, 0])]  +=  ((nucs_segm[int(ctrs_ext[-1, 0])] == ctrs_ext[0, ll]) * new_lbl).astype(np.uint16)    # add the new nucleus to the final matrix 
-                    dd                                =  np.intersect1d(np.where(ctrs_mtx[-1] == ctrs_ext[-1, ll])[0], np.where(ctrs_mtx[0] == ctrs_ext[0, ll])[0])     # identify the ctrs coordinates of the just found nucleus: use the time and the label since for each time frame nuclei labels are unique
-                    ctrs_mtx                          =  np.delete(ctrs_mtx, dd, axis=1)            # remove from the total matrix
-                else:
-                    break                                # if all the distances are higher than the threshold, just go for the next nucleus 
-
-        self.nucs_trck  =  nucs_trck
+        tracks     =  link_nearest(ctrs, dist_thr, pbar)                                      # first the track label of each nucleus,
+        nucs_trck  =  write_tracks(nucs_segm, lbls, tracks, n_threads)                           # then the whole matrix, one pass per frame
+
+        self.nucs_trck                        =  nucs_trck
+        self.tracks_table, self.tracks_index  =  TrackTable.stats_table(stats, tracks, pix_size_XY, pix_size_Z)     # a row per detection, from the stats: no voxel scan
 
 
 class Nuclei2dTracker:
-    """This class performs nuclei tracking considering only the xy coordinate of the centroids."""
-    def __init__(self, nucs_segm, dist_thr, pix_size_XY):
+    """This class performs nuclei tracking considering only the xy coordinate of the centroids (pix_size_Z is used only for the table of the tracked nuclei)."""
+    def __init__(self, nucs_segm, dist_thr, pix_size_XY, n_threads=1, pix_size_Z=1.0, stats=None):
+
+        stats       =  stats if stats is not None else frames_stats(nucs_segm, n_threads)
+        lbls, ctrs  =  frames_centroids(stats, np.array([0, pix_size_XY, pix_size_XY]))           # z coordinate is not taken into account
+
+        pbar  =  ServiceWidgets.ProgressBar(total1=sum(len(lbl) for lbl in lbls))
+        pbar.update_progressbar1(0)
+        pbar.show()
+
+        tracks     =  link_nearest(ctrs, dist_thr, pbar)                                      # first the track label of each nucleus,
+        nucs_trck  =  write_tracks(nucs_segm, lbls, tracks, n_threads)                           # then the whole matrix, one pass per frame
+
+        self.nucs_trck                        =  nucs_trck
+        self.tracks_table, self.tracks_index  =  TrackTable.stats_table(stats, tracks, pix_size_XY, pix_size_Z)     # a row per detection, from the stats: no voxel scan
 
-        nucs_trck   =  np.zeros_like(nucs_segm)                     # initialize output matrix of tracked nuclei
 
-        tlen       =  nucs_segm.shape[0]                            # number of time frames
-        ctrs_mtx   =  np.squeeze(np.asarray(list(regionprops_table(nucs_segm[0], properties=["label", "centroid"]).values())))      # matrix of centroids: label, z, x, y. time is missing
-        ctrs_mtx   =  np.delete(ctrs_mtx, 1, 0)                                                                                     # remove the z coordinate: 3xN matrix label, x, y
-        ctrs_mtx   =  np.append(ctrs_mtx, np.zeros((ctrs_mtx.shape[1]))[None, :], 0)    # 4XN matrix: you have label, x, y, time as centroid coordinates for each nucleus. Here a colomn for time is add. It is all zeros since it is the first time frame
+def candidate_pairs(ctrs_a, ctrs_b, dist_thr):
+    """Pairs (index in ctrs_a, index in ctrs_b, distance) of points closer than dist_thr, found with kd-trees."""
+    if len(ctrs_a) == 0 or len(ctrs_b) == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(0)
+    pairs  =  cKDTree(ctrs_a).sparse_distance_matrix(cKDTree(ctrs_b), dist_thr, output_type='ndarray')
+    pairs  =  pairs[pairs['v'] < dist_thr]
+    return pairs['i'].astype(int), pairs['j'].astype(int), pairs['v']
 
-        for tt in range(1, tlen):
-            ctrs_bff  =  np.squeeze(np.asarray(list(regionprops_table(nucs_segm[tt], properties=["label", "centroid"]).values())))   # extract label, z, x, y for the other time steps
-            ctrs_bff  =  np.delete(ctrs_bff, 1, 0)                                                                                   # remove the z coordinate: 3xN matrix label, x, y
-            ctrs_bff  =  np.append(ctrs_bff, tt * np.ones((ctrs_bff.shape[1]))[None, :], 0)                                          # add time to the matrix (now it is label, z, x, y, time)
-            ctrs_mtx  =  np.concatenate((ctrs_mtx, ctrs_bff), axis=1)                                                                # concatenate with hte previous
 
-        pbar      =  ServiceWidgets.ProgressBar(total1=ctrs_mtx.shape[1])
-        pbar_ref  =  ctrs_mtx.shape[1]
+def solve_assignment(rows, cols, costs, n_rows, n_cols, max_cost):
+    """One to one assignment of rows to cols among candidate pairs (each cost smaller than max_cost): the largest number of pairs, with the smallest total cost.
+
+    Candidate pairs are split in connected groups (rows and cols sharing candidates) and each group is solved
+    as a dense linear assignment on its own: groups are small even with thousands of nuclei per frame.
+    Give back the indexes of the assigned rows and cols.
+    """
+    if rows.size == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+    graph        =  coo_matrix((np.ones(rows.size), (rows, n_rows + cols)), shape=(n_rows + n_cols, n_rows + n_cols))
+    _, comps     =  connected_components(graph, directed=False)
+    order        =  np.argsort(comps[rows], kind='stable')                                  # candidate pairs grouped by component
+    bounds       =  np.flatnonzero(np.diff(comps[rows][order])) + 1
+    rows_fin, cols_fin  =  [], []
+    for grp in np.split(order, bounds):
+        grp_rows, ri  =  np.unique(rows[grp], return_inverse=True)
+        grp_cols, ci  =  np.unique(cols[grp], return_inverse=True)
+        no_pair       =  max_cost * (min(grp_rows.size, grp_cols.size) + 1)                 # costlier than any set of real pairs: the number of pairs is maximized first
+        cost_mtx      =  np.full((grp_rows.size, grp_cols.size), no_pair)
+        cost_mtx[ri, ci]  =  costs[grp]
+        rr, cc        =  linear_sum_assignment(cost_mtx)
+        keep          =  cost_mtx[rr, cc] < no_pair
+        rows_fin.append(grp_rows[rr[keep]])
+        cols_fin.append(grp_cols[cc[keep]])
+    return np.concatenate(rows_fin), np.concatenate(cols_fin)
+
+
+class NucleiAssignTracker:
+    """This class performs nuclei tracking with a global assignment between consecutive frames, then closes short gaps.
+
+    Nuclei of each couple of consecutive frames are linked all together, minimizing the sum of the distances (µm)
+    of the links among the pairs closer than dist_thr; then tracks ending in a frame are linked to tracks starting
+    up to max_gap frames later (missed detections), with the same assignment on the distance between end and start.
+    """
+    def __init__(self, nucs_segm, dist_thr, pix_size_XY, pix_size_Z, max_gap=2, n_threads=1, stats=None):
+
+        tlen        =  nucs_segm.shape[0]                                                   # number of time frames
+        stats       =  stats if stats is not None else frames_stats(nucs_segm, n_threads)
+        lbls, ctrs  =  frames_centroids(stats, np.array([pix_size_Z, pix_size_XY, pix_size_XY]))      # centroids in µm, since xy and z pixel sizes are different
+
+        pbar  =  ServiceWidgets.ProgressBar(total1=tlen)
         pbar.update_progressbar1(0)
         pbar.show()
 
-        new_lbl  =  0                                                               # new label is set to 0 since it is increased by 1
-        while ctrs_mtx.shape[1] != 0:                                               # any time some coordinates are taken, they are removed from the matrix. Tracking is done when the ctrs_mtx matrix is empty
-            pbar.update_progressbar1(pbar_ref - ctrs_mtx.shape[1])
-            new_lbl  +=  1                                                          # update label to assign
-            ctrs_ref  =  ctrs_mtx[:, 0]                                             # take a new ref ctrs
-            ctrs_mtx  =  np.delete(ctrs_mtx, 0, axis=1)                             # delete the ref from the matrix
-            nucs_trck[int(ctrs_ref[-1])]  +=  ((nucs_segm[int(ctrs_ref[-1])]  ==  ctrs_ref[0]) * new_lbl).astype(np.uint16)   # add the corresponding nucleus to the new matrix
-            for uu in range(int(ctrs_ref[-1]) + 1, tlen):                           # for all the following time frames
-                ctrs_ext  =  ctrs_mtx[:, ctrs_mtx[3, :] == uu]                      # isolate the centroids with proper time frame
-                distance  =  ctrs_ext - ctrs_ref[:, None] * np.ones_like(ctrs_ext)  # define a matrix to calculate the distance of the ref from all the centroids in the following frame
-                ppp       =  np.sqrt((distance[1, :] * pix_size_XY) ** 2 + (distance[2, :] * pix_size_XY) ** 2)    # explicit distance calculation (it is in µm since we multiply for pixel size --xy and z are different)
-                # print(ppp.min())
-                if ppp.min() < dist_thr:                 # check distance is smaller than distance threshold
-                    ll                                =  np.argmin(ppp)                 # coordinate of the min of the distance
-                    nucs_trck[int(ctrs_ext[-1, 0])]  +=  ((nucs_segm[int(ctrs_ext[-1, 0])] == ctrs_ext[0, ll]) * new_lbl).astype(np.uint16)    # add the new nucleus to the final matrix
-                    dd                                =  np.intersect1d(np.where(ctrs_mtx[-1] == ctrs_ext[-1, ll])[0], np.where(ctrs_mtx[0] == ctrs_ext[0, ll])[0])     # identify the ctrs coordinates of the just found nucleus: use the time and the label since for each time frame nuclei labels are unique
-                    ctrs_mtx                          =  np.delete(ctrs_mtx, dd, axis=1)            # remove from the total matrix
-                else:
-                    break                                # if all the distances are higher than the threshold, just go for the next nucleus
-
-        self.nucs_trck  =  nucs_trck
+        tracks   =  [np.zeros(len(lbl), dtype=np.int64) for lbl in lbls]                   # track label of each nucleus, frame by frame
+        n_trcks  =  0
+        for tt in range(tlen):
+            pbar.update_progressbar1(tt)
+            if tt > 0:
+                rows, cols            =  solve_assignment(*candidate_pairs(ctrs[tt - 1], ctrs[tt], dist_thr), len(ctrs[tt - 1]), len(ctrs[tt]), dist_thr)
+                tracks[tt][cols]      =  tracks[tt - 1][rows]                               # nuclei linked to the previous frame continue its tracks
+            new_trcks             =  tracks[tt] == 0
+            tracks[tt][new_trcks]  =  n_trcks + 1 + np.arange(new_trcks.sum())              # the others start new tracks
+            n_trcks               +=  new_trcks.sum()
+
+        starts  =  np.full((n_trcks + 1, 2), -1)                                            # (frame, index in the frame) of the first and of the last nucleus of each track
+        ends    =  np.full((n_trcks + 1, 2), -1)
+        for tt in range(tlen):
+            jjs                         =  np.arange(len(tracks[tt]))
+            first                       =  starts[tracks[tt], 0] < 0
+            starts[tracks[tt][first]]   =  np.column_stack([np.full(first.sum(), tt), jjs[first]])
+            ends[tracks[tt]]            =  np.column_stack([np.full(jjs.size, tt), jjs])
+        ends_trcks, starts_trcks, gaps_dists  =  [np.zeros(0, dtype=int)], [np.zeros(0, dtype=int)], [np.zeros(0)]     # candidate gap closings
+        for tt in range(tlen):
+            ending  =  np.where(ends[:, 0] == tt)[0]
+            for gap in range(2, min(max_gap + 2, tlen - tt)):                               # start gap frames after the end (1 frame is a normal link)
+                starting    =  np.where(starts[:, 0] == tt + gap)[0]
+                ii, jj, dd  =  candidate_pairs(ctrs[tt][ends[ending, 1]], ctrs[tt + gap][starts[starting, 1]], dist_thr)
+                ends_trcks.append(ending[ii])
+                starts_trcks.append(starting[jj])
+                gaps_dists.append(dd)
+        rows, cols  =  solve_assignment(np.concatenate(ends_trcks), np.concatenate(starts_trcks), np.concatenate(gaps_dists), n_trcks + 1, n_trcks + 1, dist_thr)
+
+        trcks_lut         =  np.arange(n_trcks + 1)                                         # track -> track it continues after a gap
+        trcks_lut[cols]   =  rows
+        for trk in range(n_trcks + 1):                                                      # tracks are numbered in time order: a track continues an already resolved one
+            trcks_lut[trk]  =  trcks_lut[trcks_lut[trk]]
+        _, trcks_lut  =  np.unique(trcks_lut, return_inverse=True)                          # consecutive labels, in order of first appearance
+
+        tracks     =  [trcks_lut[trk] for trk in tracks]
+        nucs_trck  =  write_tracks(nucs_segm, lbls, tracks, n_threads)
+
+        pbar.close()
+        self.nucs_trck                        =  nucs_trck
+        self.tracks_table, self.tracks_index  =  TrackTable.stats_table(stats, tracks, pix_size_XY, pix_size_Z)     # a row per detection, from the stats: no voxel scan
+
+
+def overlap_table(lbls_a, lbls_b):
+    """Sparse contingency table of two label matrices: labels (a, b) of the overlapping couples and their intersection over union, from a single bincount pass over the paired voxels."""
+    n_b       =  int(lbls_b.max()) + 1
+    both      =  (lbls_a > 0) & (lbls_b > 0)
+    inters    =  np.bincount(lbls_a[both].astype(np.int64) * n_b + lbls_b[both])        # voxels in common of each couple, couple coded as a * n_b + b
+    codes     =  np.flatnonzero(inters)
+    aa, bb    =  np.divmod(codes, n_b)
+    areas_a   =  np.bincount(lbls_a.ravel())
+    areas_b   =  np.bincount(lbls_b.ravel())
+    return aa, bb, inters[codes] / (areas_a[aa] + areas_b[bb] - inters[codes])
+
+
+def overlap_links(aa, bb, ious, min_iou=0.0):
+    """One to one links from a contingency table: couples are taken in decreasing intersection over union (larger than min_iou), skipping labels already linked."""
+    order              =  np.argsort(-ious, kind='stable')
+    used_a, used_b     =  set(), set()
+    links_a, links_b   =  [], []
+    for kk in order:
+        if ious[kk] <= min_iou:
+            break
+        if aa[kk] in used_a or bb[kk] in used_b:
+            continue
+        used_a.add(aa[kk])
+        used_b.add(bb[kk])
+        links_a.append(aa[kk])
+        links_b.append(bb[kk])
+    return np.array(links_a, dtype=np.int64), np.array(links_b, dtype=np.int64)
 
 
 class NucleiOverlTracker:
-    """This class performs nuclei tracking projecting the calc of each nucleus in the following frame and check the overlapping one by median."""
-    def __init__(self, nucs_segm):
+    """This class performs nuclei tracking linking each nucleus to the nucleus of the following frame it overlaps the most.
+
+    Nuclei move slowly with respect to their size: the contingency table of the labels of two consecutive frames
+    gives the intersection over union of the overlapping nuclei, and links are taken in decreasing intersection over
+    union (one to one, above min_iou). Tables of the frame pairs are computed on a pool of n_threads threads.
+    Nuclei of the first frame give the tracks; nuclei not linked to a track are not kept. The table of the tracked
+    nuclei (tracks_table) is filled from stats, the labels, volumes, centroids and bounding boxes of the nuclei of
+    each frame given by the segmenter (measured here if missing), and pixel sizes.
+    With use_checkpoint the tracked frames are written on disk every checkpoint_every frames and an interrupted
+    run on the same segmented nuclei resumes from the last checkpoint; a frame whose tracking fails is left
+    empty, recorded in failed_frames, and the following frame is tracked with respect to the last tracked one.
+    """
+    def __init__(self, nucs_segm, min_iou=0.0, n_threads=1, use_checkpoint=True, checkpoint_every=10, pix_size_XY=1.0, pix_size_Z=1.0, stats=None):
 
         nucs_trck     =  np.zeros_like(nucs_segm)                                   # initialize output matrix of tracked nuclei
         nucs_trck[0]  =  np.copy(nucs_segm[0])                                      # first frameof tracked can be taken as the first frame of segmented
         tlen          =  nucs_segm.shape[0]                                         # number of time frames
+        ref_tt        =  0                                                          # last frame tracked without errors: reference for the following one
+        ref_tags      =  np.arange(int(nucs_segm[0].max()) + 1, dtype=nucs_trck.dtype)     # segmented label -> track label in the reference frame
+        failed        =  dict()                                                     # time frame -> error message
+        frames_tags   =  [ref_tags] + [None] * (tlen - 1)                           # segmented label -> track label of each frame (None for the failed ones)
+
+        ckpt      =  RunCheckpoint.RunCheckpoint("overl_track", RunCheckpoint.frames_hashes(nucs_segm), {"min_iou": min_iou}) if use_checkpoint else None
+        tt_start  =  1
+        if ckpt is not None and ckpt.frames_done > 1:                               # resume from the last checkpoint
+            for tt in range(ckpt.frames_done):
+                nucs_trck[tt]                   =  ckpt.load_frame(tt)
+                frames_tags[tt]                 =  np.zeros(int(nucs_segm[tt].max()) + 1, dtype=nucs_trck.dtype)
+                frames_tags[tt][nucs_segm[tt]]  =  nucs_trck[tt]                    # frames of the checkpoint give back their tags from the voxels
+            tt_start  =  ckpt.frames_done
+            ref_tt    =  ckpt.state["ref_tt"]
+            ref_tags  =  np.array(ckpt.state["ref_tags"], dtype=nucs_trck.dtype)
+            failed    =  ckpt.failed
 
         pbar  =  ServiceWidgets.ProgressBar(total1=tlen)
         pbar.show()
         pbar.update_progressbar1(0)
 
-        for tt in range(1, tlen):                                                       # for all the frames following the first
-            pbar.update_progressbar1(tt)
-            nucs_bff   =  nucs_trck[tt - 1]                                             # isolate the previous tracked frame matrix
-            rgp_bff    =  regionprops_table(nucs_bff, properties=["label", "coords"])   # regionprops for label and coordinates (work with coordinates is faster)
-            nucs_tags  =  np.unique(nucs_bff[nucs_bff != 0])                            # array of all the tags in the previous tracked frame
-            rgp_next   =  regionprops_table(nucs_segm[tt], properties=["label", "coords"])  # regionprops of the segmented nuclei in the following frames for label and coords
-            for nuc_tag in nucs_tags:                                                   # for each nucleus
-                jj_bff   =  np.where(rgp_bff["label"] == nuc_tag)[0][0]                 # search the index of the proper label
-                nxt_tag  =  nucs_segm[tt, rgp_bff["coords"][jj_bff][:, 0], rgp_bff["coords"][jj_bff][:, 1], rgp_bff["coords"][jj_bff][:, 2]]  # use nucleus coordinates in the following frame to check the tags of the overlapping nuclei
-                nxt_tag  =  np.median(nxt_tag[nxt_tag != 0])                            # take the median (the nucleus mostly overlapped)
-                if nxt_tag - np.fix(nxt_tag) == 0.0:                                    # eventually, in some special and rare cases, you can have deciaml results; these must be avoided (maybe do something smarter than just remove)
-                    jj_next         =  np.where(rgp_next["label"] == nxt_tag)[0][0]     # check the index of the tag in the label dictionary
-                    nucs_trck[tt, rgp_next["coords"][jj_next][:, 0], rgp_next["coords"][jj_next][:, 1], rgp_next["coords"][jj_next][:, 2]]  =  nuc_tag   # add the nucleus with the proper tag to the matrix of the tracked nuclei
+        with ThreadPoolExecutor(n_threads) as executor:
+            tables  =  [executor.submit(overlap_table, nucs_segm[tt - 1], nucs_segm[tt]) for tt in range(tt_start, tlen)]     # tables of consecutive frames, in parallel
+            for tt, table in zip(range(tt_start, tlen), tables):                    # for all the frames following the first
+                pbar.update_progressbar1(tt)
+                try:
+                    table  =  table.result() if ref_tt == tt - 1 else overlap_table(nucs_segm[ref_tt], nucs_segm[tt])      # if the previous frame failed, overlap with the last tracked one
+                    aa, bb, ious   =  table
+                    tracked        =  ref_tags[aa] != 0                             # only nuclei of a track compete for the links: an untracked nucleus must not take the nucleus of a track
+                    aa, bb         =  overlap_links(aa[tracked], bb[tracked], ious[tracked], min_iou)
+                    tags           =  np.zeros(int(nucs_segm[tt].max()) + 1, dtype=nucs_trck.dtype)     # segmented label -> track label in this frame
+                    tags[bb]       =  ref_tags[aa]
+                    np.take(tags, nucs_segm[tt], out=nucs_trck[tt])
+                    ref_tt, ref_tags  =  tt, tags
+                    frames_tags[tt]   =  tags
+                except Exception:                                                   # a single frame must not stop the tracking of the whole movie
+                    traceback.print_exc()
+                    nucs_trck[tt]  =  0
+                    failed[tt]     =  traceback.format_exc()
 
+                if ckpt is not None and (tt + 1) % checkpoint_every == 0:
+                    ckpt.save(nucs_trck, tt + 1, {"ref_tt": ref_tt, "ref_tags": ref_tags.tolist()}, failed)
+
+        if ckpt is not None:
+            ckpt.remove()                                                           # the run is over: the result is in nucs_trck
         pbar.close()
-        self.nucs_trck  =  nucs_trck
+        stats   =  stats if stats is not None else frames_stats(nucs_segm, n_threads)
+        tracks  =  [tags[stat[0]] if tags is not None else np.zeros(len(stat[0]), dtype=nucs_trck.dtype) for stat, tags in zip(stats, frames_tags)]     # track label of each segmented nucleus
+
+        self.nucs_trck                        =  nucs_trck
+        self.failed_frames                    =  failed
+        self.tracks_table, self.tracks_index  =  TrackTable.stats_table(stats, tracks, pix_size_XY, pix_size_Z)     # a row per detection, from the stats: no voxel scan
 
 
 # class ProgressBar(QtWidgets.QWidget):
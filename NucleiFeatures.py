@@ -0,0 +1,140 @@
+"""This function measures the shape features the classifier uses to recognize badly segmented nuclei.
+
+Features are the 22 columns of regionprops_table (area, area_bbox, area_convex, area_filled,
+axis_major_length, axis_minor_length, equivalent_diameter_area, extent, feret_diameter_max,
+inertia_tensor_eigvals, solidity, inertia_tensor) in the order finalized_model.sav expects.
+Voxel number, centroid, central second order moments and bounding box of each fragment are
+measured only once: the ones of a union of fragments are combined from them, without building
+the mask of the union. Convex area, filled area and feret diameter are not additive and are
+measured on the union cropped to its bounding box.
+Features of all the nuclei of a frame are measured in a single pass (frame_features).
+"""
+
+
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from skimage.measure import regionprops, marching_cubes
+from scipy.spatial import ConvexHull, QhullError
+from scipy.spatial.distance import pdist
+from scipy.ndimage import find_objects
+import joblib
+
+
+FEATURES_NAMES  =  ["area", "area_bbox", "area_convex", "area_filled", "axis_major_length", "axis_minor_length", "equivalent_diameter_area",
+                    "extent", "feret_diameter_max", "inertia_tensor_eigvals", "solidity", "inertia_tensor"]                                 # properties of regionprops_table used to train the classifier
+CLASSIFIERS     =  dict()                                                                                                                 # file name -> classifier already loaded in this process
+
+
+def load_classifier(fname='finalized_model.sav', n_jobs=None):
+    """Give the pretrained classifier, read from disk only once per process; n_jobs sets the number of threads of its predictions."""
+    if fname not in CLASSIFIERS:
+        CLASSIFIERS[fname]  =  joblib.load(fname)
+    if n_jobs is not None:
+        CLASSIFIERS[fname].n_jobs  =  n_jobs
+    return CLASSIFIERS[fname]
+
+
+def shape_features(area, ctr_moments, bbox, area_convex, area_filled, feret):
+    """Build the (n, 22) features matrix of n objects from voxel numbers, central second order moments ((n, 3, 3), sums of (p - c)(p - c)^T), bounding boxes ((n, 2, 3), [min, max) per axis) and non additive features."""
+    area            =  np.asarray(area, dtype=float)
+    inertia_tensor  =  (np.trace(ctr_moments, axis1=1, axis2=2)[:, None, None] * np.eye(3) - ctr_moments) / area[:, None, None]     # same definition of skimage: diagonal terms are the sum of the moments of the other axes
+    eigvals         =  np.sort(np.clip(np.linalg.eigvalsh(inertia_tensor), 0, None), axis=1)[:, ::-1]
+    area_bbox       =  np.prod(bbox[:, 1] - bbox[:, 0], axis=1)
+    with np.errstate(divide='ignore'):                                                                  # flat objects have 0 convex area, and infinite solidity as in regionprops
+        solidity  =  area / np.asarray(area_convex, dtype=float)
+    return np.column_stack([area, area_bbox, area_convex, area_filled,
+                            np.sqrt(np.maximum(0, 10 * (eigvals[:, 0] + eigvals[:, 1] - eigvals[:, 2]))),           # axis_major_length
+                            np.sqrt(np.maximum(0, 10 * (-eigvals[:, 0] + eigvals[:, 1] + eigvals[:, 2]))),          # axis_minor_length
+                            (6 * area / np.pi) ** (1 / 3),                                                          # equivalent_diameter_area
+                            area / area_bbox, feret, eigvals, solidity, inertia_tensor.reshape(-1, 9)])
+
+
+def hull_features(crop):
+    """Convex area, filled area and feret diameter of the object of a binary matrix cropped to its bounding box (same definitions of regionprops)."""
+    region        =  regionprops(crop.astype(np.uint8))[0]
+    image_convex  =  region.image_convex
+    verts         =  marching_cubes(np.pad(image_convex if image_convex.any() else crop, 2), level=0.5)[0]    # surface of the convex hull (of the object itself for flat objects, whose convex image is empty)
+    try:
+        verts  =  verts[ConvexHull(verts).vertices]                                                        # the farthest points are vertices of the hull: no need to measure all the distances
+    except QhullError:                                                                                     # flat hulls
+        pass
+    return np.sum(image_convex), region.area_filled, np.sqrt(np.max(pdist(verts, 'sqeuclidean')))
+
+
+def centroids_volumes(lbls_mtx):
+    """Labels, voxel numbers, centroids ((n, 3), voxels) and bounding boxes ((n, 6), [z0, x0, y0, z1, x1, y1]) of all the objects of a label matrix, in one pass with bincount (and one with find_objects)."""
+    idxs     =  np.flatnonzero(lbls_mtx)                                                   # raster indexes of the object voxels: cheaper than np.nonzero
+    vals     =  lbls_mtx.ravel()[idxs]
+    coords   =  np.unravel_index(idxs, lbls_mtx.shape)
+    n_bins   =  int(lbls_mtx.max()) + 1
+    areas    =  np.bincount(vals, minlength=n_bins)
+    lbls     =  np.flatnonzero(areas[1:]) + 1
+    ctrs     =  np.column_stack([np.bincount(vals, weights=crd, minlength=n_bins)[lbls] for crd in coords]).reshape(-1, lbls_mtx.ndim) / areas[lbls][:, None]
+    slices   =  find_objects(lbls_mtx)
+    bboxes   =  np.array([[ss.start for ss in slices[lbl - 1]] + [ss.stop for ss in slices[lbl - 1]] for lbl in lbls], dtype=np.int32).reshape(-1, 2 * lbls_mtx.ndim)
+    return lbls, areas[lbls], ctrs, bboxes
+
+
+def frame_features(lbls_mtx, n_threads=1):
+    """Features of all the objects of a label matrix, same values and order of regionprops_table; give back labels and (n_labels, 22) features matrix.
+
+    Voxel numbers, centroids and central moments of all the objects are measured in one pass with bincount,
+    non additive features in the bounding box of each object, on a pool of n_threads threads.
+    """
+    slices       =  find_objects(lbls_mtx)
+    lbls         =  np.array([cnt + 1 for cnt, slc in enumerate(slices) if slc is not None], dtype=np.int64)
+    coords       =  np.nonzero(lbls_mtx)
+    vals         =  lbls_mtx[coords]
+    n_bins       =  len(slices) + 1
+    areas        =  np.bincount(vals, minlength=n_bins)
+    ctrs         =  [np.bincount(vals, weights=crd, minlength=n_bins) / np.maximum(areas, 1) for crd in coords]         # centroids of all the objects, per axis
+    coords       =  [crd - ctr[vals] for crd, ctr in zip(coords, ctrs)]                                                 # coordinates with respect to the centroid of their object
+    ctr_moments  =  np.zeros((n_bins, 3, 3))
+    for ii in range(3):
+        for jj in range(ii, 3):
+            ctr_moments[:, ii, jj]  =  ctr_moments[:, jj, ii]  =  np.bincount(vals, weights=coords[ii] * coords[jj], minlength=n_bins)
+
+    with ThreadPoolExecutor(n_threads) as executor:
+        hulls  =  np.asarray(list(executor.map(lambda lbl: hull_features(lbls_mtx[slices[lbl - 1]] == lbl), lbls)), dtype=float).reshape(-1, 3)
+    bboxes  =  np.array([[[ss.start for ss in slices[lbl - 1]], [ss.stop for ss in slices[lbl - 1]]] for lbl in lbls]).reshape(-1, 2, 3)
+    return lbls, shape_features(areas[lbls], ctr_moments[lbls], bboxes, hulls[:, 0], hulls[:, 1], hulls[:, 2])
+
+
+class FragmentsFeatures:
+    """Measure the additive moments of the fragments of a label matrix, to give the features of any union of them."""
+    def __init__(self, lbls_mtx, lbls):
+
+        slices   =  find_objects(lbls_mtx)
+        moments  =  dict()                                                      # label -> (voxel number, centroid, central second order moments, bounding box)
+        for lbl in lbls:
+            slc  =  slices[lbl - 1]
+            if slc is None:
+                continue
+            coords        =  np.argwhere(lbls_mtx[slc] == lbl) + [s.start for s in slc]            # coordinates of the fragment voxels, computed in its bounding box only
+            ctr           =  coords.mean(axis=0)
+            coords_c      =  coords - ctr
+            moments[lbl]  =  (coords.shape[0], ctr, coords_c.T @ coords_c, np.array([[s.start for s in slc], [s.stop for s in slc]]))
+
+        self.moments  =  moments
+
+    def bbox_slice(self, lbls):
+        """Bounding box (tuple of slices) of the union of the fragments lbls."""
+        frags  =  [self.moments[lbl] for lbl in lbls]
+        return tuple(slice(b0, b1) for b0, b1 in zip(np.min([frag[3][0] for frag in frags], axis=0), np.max([frag[3][1] for frag in frags], axis=0)))
+
+    def size(self, lbls):
+        """Voxel number and bounding box volume of the union of the fragments lbls (both can only grow adding fragments)."""
+        frags  =  [self.moments[lbl] for lbl in lbls]
+        bbox   =  np.array([np.min([frag[3][0] for frag in frags], axis=0), np.max([frag[3][1] for frag in frags], axis=0)])
+        return sum(frag[0] for frag in frags), np.prod(bbox[1] - bbox[0])
+
+    def features(self, lbls_mtx, lbls):
+        """Features of the union of the fragments lbls of lbls_mtx."""
+        frags        =  [self.moments[lbl] for lbl in lbls]
+        area         =  sum(frag[0] for frag in frags)
+        ctr          =  sum(frag[0] * frag[1] for frag in frags) / area
+        ctr_moments  =  sum(frag[2] + frag[0] * np.outer(frag[1] - ctr, frag[1] - ctr) for frag in frags)     # parallel axis theorem: moments of each fragment moved to the centroid of the union
+        bbox         =  np.array([np.min([frag[3][0] for frag in frags], axis=0), np.max([frag[3][1] for frag in frags], axis=0)])
+
+        crop  =  np.isin(lbls_mtx[tuple(slice(b0, b1) for b0, b1 in zip(*bbox))], lbls)                         # union of the fragments in its bounding box
+        return shape_features([area], ctr_moments[None], bbox[None], *[[hull] for hull in hull_features(crop)])[0]
@@ -7,120 +7,426 @@ Input is raw data and training.
 """
 
 
-import itertools
+import os
+import time
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED, ALL_COMPLETED
 import numpy as np
 from skimage.measure import label, regionprops_table
 from skimage.filters import gaussian, threshold_otsu
 from skimage.segmentation import watershed, expand_labels
 from skimage.feature import peak_local_max
-from scipy.ndimage import distance_transform_edt
-import joblib
+from scipy.ndimage import distance_transform_edt, find_objects, gaussian_filter
 # import pyqtgraph as pg
 
 import ServiceWidgets
+import NucleiFeatures
+import SegmentationCache
 
 
-def all_possible_subsets(s):
-    """This function gives all the possible subset (without repetitions) of the first s numbers."""
-    sub_sets  =  []
-    for k in range(1, s + 1):
-        sub_sets  +=  list(itertools.combinations(np.arange(s), k))
-    return sub_sets
+MAX_CANDIDATES  =  256                                                                                               # maximum number of possible nuclei tested for each over segmented object
+SIZE_MARGIN     =  1.2                                                                                               # possible nuclei bigger than the biggest well segmented nucleus of the frame times this factor are discarded
+PEAKS_FOOTPRINT =  np.ones((5, 11, 11))                                                                              # footprint of the search of the peaks of the distance matrix
+EDT_CHUNK       =  32                                                                                                # width (voxels) of the chunks along y in which distance matrices are computed
+EDT_MARGIN      =  16                                                                                                # first margin (voxels) of the chunks, doubled when the distances need it
+WORKER_FRAMES   =  15                                                                                                # memory of a worker process, in frames: segmentation peak (12.8 frames) plus the frame it segments and the one waiting for it
+MEMORY_FRACTION =  0.5                                                                                               # fraction of the available memory the worker processes can take
+SEGMENTATION_VERSION  =  1                                                                                           # to increase when the results of the segmentation change, so that cached frames are not used anymore
+
+
+def pad_slice(slc, shape, pad=1):
+    """Enlarge a bounding box (tuple of slices) of pad voxels on each side, without going out of a matrix of given shape."""
+    return tuple(slice(max(ss.start - pad, 0), min(ss.stop + pad, sh)) for ss, sh in zip(slc, shape))
+
+
+def union_slice(slc1, slc2):
+    """Smallest bounding box (tuple of slices) containing two bounding boxes."""
+    return tuple(slice(min(s1.start, s2.start), max(s1.stop, s2.stop)) for s1, s2 in zip(slc1, slc2))
+
+
+def label_dtype(n_labels):
+    """Smallest unsigned integer type able to store n_labels labels."""
+    return np.min_scalar_type(max(int(n_labels), 255))
+
+
+def first_voxels(lbls_mtx, slices):
+    """Raster index in the matrix of the first voxel of each label (-1 for labels no more present), searched in the bounding boxes slices.
+
+    Raster order restricted to a box is the raster order of the matrix: the first voxel in the box is the first one in the matrix.
+    """
+    firsts  =  np.full(len(slices) + 1, -1, dtype=np.int64)
+    for lbl, slc in enumerate(slices, start=1):
+        if slc is None:
+            continue
+        msk  =  lbls_mtx[slc] == lbl
+        if msk.any():
+            firsts[lbl]  =  np.ravel_multi_index(tuple(crd + ss.start for crd, ss in zip(np.unravel_index(np.argmax(msk), msk.shape), slc)), lbls_mtx.shape)
+    return firsts
+
+
+def smooth_threshold(frame):
+    """Gaussian smoothing (sigma 2) and Otsu threshold of a frame in low memory: smoothing in float32, histogram computed in blocks."""
+    smooth  =  gaussian_filter(frame, 2, output=np.float32, mode='nearest', truncate=4.0)                          # same filter of skimage gaussian, without the float64 copies
+    if smooth.min() == smooth.max():                                                                                # flat frame
+        return np.zeros(frame.shape, dtype=bool)
+    counts, edges  =  np.histogram(smooth, bins=256, range=(smooth.min(), smooth.max()))                           # same 256 bins of threshold_otsu
+    return smooth > threshold_otsu(hist=(counts, (edges[:-1] + edges[1:]) / 2))
+
+
+def distance_map(comp):
+    """Euclidean distance matrix of a binary matrix in float32, computed in chunks along y to limit memory.
+
+    Each chunk is computed with margins on both sides larger than the largest distance found in it (doubled until
+    it is so), so the nearest background voxel of each voxel is always in the margins and values are exact.
+    """
+    distance  =  np.zeros(comp.shape, dtype=np.float32)
+    ylen      =  comp.shape[-1]
+    for y0 in range(0, ylen, EDT_CHUNK):
+        y1      =  min(y0 + EDT_CHUNK, ylen)
+        margin  =  EDT_MARGIN
+        while True:
+            m0, m1      =  max(y0 - margin, 0), min(y1 + margin, ylen)
+            dist_chunk  =  distance_transform_edt(comp[..., m0:m1])[..., y0 - m0:y1 - m0]
+            if dist_chunk.max() <= margin or (m0 == 0 and m1 == ylen):
+                break
+            margin  *=  2
+        distance[..., y0:y1]  =  dist_chunk
+    return distance
+
+
+def split_component(nuc_lbls, slc, lbl):
+    """Watershed of a single connected component of the thresholded frame, in its bounding box slc (1 voxel larger than the component).
+
+    The nearest background voxel of each voxel of the component is in the box, so the distance matrix is the one of the
+    whole frame; peaks on the faces of the frame are excluded as peak_local_max does on the whole frame.
+    Return the labels of the component (numbered in the box) and the raster index in the frame of the first voxel of each marker.
+    """
+    comp      =  nuc_lbls[slc] == lbl
+    distance  =  distance_map(comp)                                                                                 # distance matrix for watershed (square roots of integers: float32 keeps ties and order)
+    inner     =  comp.copy()                                                                                        # component without the voxels on the faces of the frame
+    for ax, ss in enumerate(slc):
+        if ss.start == 0:
+            inner[(slice(None),) * ax + (0,)]  =  False
+        if ss.stop == nuc_lbls.shape[ax]:
+            inner[(slice(None),) * ax + (-1,)]  =  False
+
+    markers  =  np.zeros(comp.shape, dtype=np.int32)
+    if inner.any():
+        roi         =  find_objects(inner.astype(np.uint8))[0]
+        local_maxi  =  peak_local_max(distance[roi], footprint=PEAKS_FOOTPRINT, labels=inner[roi].astype(np.uint8), threshold_abs=0, exclude_border=False) + [ss.start for ss in roi]     # find peaks of distance matrix
+        markers[tuple(local_maxi.T)]  =  1                                                                          # peaks in a 3D matrix
+    markers   =  label(markers)                                                                                     # label markers
+    nucs      =  watershed(-distance, markers, mask=comp)                                                           # watershed
+
+    coords    =  np.nonzero(markers)                                                                                # raster order
+    _, first  =  np.unique(markers[coords], return_index=True)                                                      # first voxel of each marker
+    firsts    =  np.ravel_multi_index(tuple(crd[first] + ss.start for crd, ss in zip(coords, slc)), nuc_lbls.shape)
+    return comp, nucs, firsts
+
+
+def split_nuclei(aze1, n_threads=1):
+    """Split the thresholded frame in nuclei with a watershed on the distance matrix, one connected component at the time on a pool of threads.
+
+    Labels are given in the raster order of the first voxel of their marker, as labeling the markers of the whole frame.
+    """
+    nuc_lbls  =  label(aze1)                                                                                        # label connected components
+    slices    =  find_objects(nuc_lbls)
+    firsts    =  []                                                                                                 # raster index of the first voxel of the markers, component by component
+    n_done    =  0
+    with ThreadPoolExecutor(n_threads) as executor:
+        for lbl, (comp, nucs, firsts_comp) in enumerate(executor.map(lambda lbl: split_component(nuc_lbls, pad_slice(slices[lbl - 1], nuc_lbls.shape), lbl), range(1, len(slices) + 1)), start=1):
+            slc                   =  pad_slice(slices[lbl - 1], nuc_lbls.shape)
+            nuc_lbls[slc][comp]   =  -(nucs[comp] + n_done * (nucs[comp] > 0))                                     # written in place as soon as ready, with negative provisional labels so that components still to split are not touched
+            n_done               +=  firsts_comp.size
+            firsts.append(firsts_comp)
+
+    firsts                        =  np.concatenate([np.zeros(0, dtype=np.int64)] + firsts)
+    lut                           =  np.zeros(firsts.size + 1, dtype=nuc_lbls.dtype)
+    lut[1 + np.argsort(firsts)]   =  np.arange(1, firsts.size + 1)                                                 # from provisional labels to labels of the whole frame
+    nuc_fin                       =  np.negative(nuc_lbls, out=nuc_lbls)
+    np.take(lut, nuc_fin, out=nuc_fin)
+    return nuc_fin
+
+
+def search_merges(frags_feats, over_mtx, seeds, neighbours, model, size_max):
+    """Search, for each seed fragment, the smallest union with its touching fragments that the classifier recognizes as a well segmented nucleus.
+
+    Unions are grown one fragment at the time (all the neighbours touch the seed, so unions are always connected);
+    unions with volume or bounding box bigger than size_max are discarded together with all the unions containing them,
+    the search of a seed stops at the first size with an accepted union or after MAX_CANDIDATES unions.
+    Searches of all the seeds go on together, so that the classifier runs once per union size on all of them.
+    Return the labels of the union for each seed (None if no union is accepted).
+    """
+    merges   =  [None] * len(seeds)
+    levels   =  {cnt: [()] for cnt in range(len(seeds))}                                                            # unions of the previous size of each active search (as indexes of neighbours)
+    n_cands  =  np.zeros(len(seeds), dtype=int)
+    while levels:
+        cands  =  []                                                                                                # (search, union) of all the active searches
+        for cnt in list(levels):
+            new_level  =  [subset + (kk,) for subset in levels[cnt] for kk in range((subset[-1] + 1) if subset else 0, len(neighbours[cnt]))]      # add one more neighbour to each union (in increasing order, no repetitions)
+            new_level  =  [subset for subset in new_level if np.all(np.asarray(frags_feats.size([seeds[cnt]] + [neighbours[cnt][kk] for kk in subset])) <= size_max)]
+            new_level  =  new_level[:MAX_CANDIDATES - n_cands[cnt]]
+            if not new_level:                                                                                       # nothing left to test
+                del levels[cnt]
+                continue
+            levels[cnt]     =  new_level
+            n_cands[cnt]   +=  len(new_level)
+            cands          +=  [(cnt, subset) for subset in new_level]
+        if not cands:
+            break
+
+        features_bff  =  np.asarray([frags_feats.features(over_mtx, [seeds[cnt]] + [neighbours[cnt][kk] for kk in subset]) for cnt, subset in cands])      # features of each possible nucleus, combined from the moments of its fragments
+        preds_bff     =  model.predict(features_bff)                                                                # use the trained model to make predictions on all the possible nuclei at once
+        for (cnt, subset), pred in zip(cands, preds_bff):
+            if pred == 0:                                                                                           # a possbile nucleus that the trained model recognizes as well segmented: the last one of its search is kept
+                merges[cnt]  =  [seeds[cnt]] + [neighbours[cnt][kk] for kk in subset]
+        for cnt in list(levels):
+            if merges[cnt] is not None or n_cands[cnt] >= MAX_CANDIDATES:
+                del levels[cnt]
+    return merges
+
+
+def segment_frame(frame, model, n_threads=1, tiled=True):
+    """Segment the nuclei of a single time frame (z, x, y) using the pretrained classifier to fix the badly segmented ones.
+
+    n_threads are used for the watershed and to measure features; with tiled the watershed runs on each connected component separately.
+    """
+    if tiled:
+        aze1     =  smooth_threshold(frame)                                                                         # float32 smoothing
+        nuc_fin  =  split_nuclei(aze1, n_threads)                                                                   # each connected component in its own box
+        del aze1
+    else:
+        aa_g0       =  gaussian(frame, 2)                                                                               # smoothing with a gaussian filter
+        val1        =  threshold_otsu(aa_g0)                                                                            # threshold for detetction
+        aze1        =  aa_g0 > val1
+        nuc_lbls    =  label(aze1).astype(np.uint16)                                                                    # label connected components
+        distance    =  distance_transform_edt(nuc_lbls)                                                                 # distance matrix for watershed
+        local_maxi  =  peak_local_max(distance, footprint=PEAKS_FOOTPRINT, labels=label(nuc_lbls))                      # find peaks of distance matrix
+        markers     =  np.zeros_like(nuc_lbls)
+        for k in local_maxi:
+            markers[k[0], k[1], k[2]]  =  1                                                                             # peaks in a 3D matrix
+        markers     =  label(markers)                                                                                   # label markers
+        nuc_fin     =  watershed(-distance, markers, mask=np.sign(nuc_lbls))                                            # watershed
+
+    rgp_tot  =  regionprops_table(nuc_fin, properties=["label", "solidity", "coords"])                              # regionprops of the segmtend nuclei
+    uus      =  np.where(np.isinf(rgp_tot["solidity"]))[0]                                                          # identify spots with infinitive solidity (clear errors in segmentation, non-3D objects)
+    slices   =  find_objects(nuc_fin)                                                                               # bounding boxes of the nuclei: all the operations on a single nucleus are done in its bounding box
+    for uu in uus:
+        lbl_uu   =  rgp_tot["label"][uu]
+        slc      =  pad_slice(slices[lbl_uu - 1], nuc_fin.shape)                                                    # 1 voxel larger than the nucleus, to contain its expansion
+        msk_uu   =  nuc_fin[slc] == lbl_uu
+        bff_mtx  =  (expand_labels(msk_uu) - msk_uu * 1) * nuc_fin[slc]                                             # expand label of problematic detection
+        bff_idx  =  np.unique(bff_mtx[bff_mtx != 0])                                                                        # find the label of touching nuclei
+        if bff_idx.size > 0:
+            nuc_fin[rgp_tot["coords"][uu][:, 0], rgp_tot["coords"][uu][:, 1], rgp_tot["coords"][uu][:, 2]]  =  bff_idx[0]  # change the label of the problematic component into the label of touching object (if more than one touching objects is present, just connect with the first -solidity infinitive objects are super small)
+            slices[bff_idx[0] - 1]  =  union_slice(slices[bff_idx[0] - 1], slices[lbl_uu - 1])                     # the touching nucleus grew
+    del rgp_tot
+
+    border          =  np.unique(np.concatenate([nuc_fin[:, :2].ravel(), nuc_fin[:, -2:].ravel(), nuc_fin[:, :, :2].ravel(), nuc_fin[:, :, -2:].ravel()]))     # labels of the nuclei touching the border (2 pixels thick on x and y), read on the faces only
+    firsts          =  first_voxels(nuc_fin, slices)
+    firsts[border]  =  -1                                                                                           # nuclei touching the border are removed
+    kept            =  np.where(firsts >= 0)[0]
+    kept            =  kept[np.argsort(firsts[kept])]                                                                      # raster order of the first voxel, as labelling the matrix
+    lut             =  np.zeros(len(slices) + 1, dtype=label_dtype(kept.size))
+    lut[kept]       =  np.arange(1, kept.size + 1)
+    nuc_fin         =  lut[nuc_fin]                                                                                      # remove the nuclei touching the border and re-label in a single pass
+    # nuc_fin2  =  np.copy(nuc_fin)
+    iso_lbls, features  =  NucleiFeatures.frame_features(nuc_fin, n_threads)                                    # same features of regionprops_table, all the nuclei in one pass
+    preds      =  model.predict(features)                                                                           # run the classifier (trained before) on the features matrix
+    idxs_over  =  np.where(preds == 1)[0]                                                                           # identify the over segmented nuclei (labeled 1)
+    over_lut   =  np.zeros(nuc_fin.max() + 1, dtype=nuc_fin.dtype)                                                  # look up table: label of the over segmented nuclei, 0 for the others
+    over_lut[iso_lbls[idxs_over]]  =  iso_lbls[idxs_over]
+    over_mtx   =  over_lut[nuc_fin]                                                                                 # matrix of the over segmented nuclei, in a single pass
+    # over_mtx2  =  np.copy(over_mtx)
+    frags_feats  =  NucleiFeatures.FragmentsFeatures(over_mtx, iso_lbls[idxs_over])                               # moments of the over segmented fragments, measured once
+    size_max     =  SIZE_MARGIN * features[preds == 0][:, :2].max(axis=0) if 0 in preds else np.inf               # volume and bounding box limits, learned from the well segmented nuclei of the frame
+    neighbours   =  dict()                                                                                          # fragments touching each over segmented fragment
+    for lbl in iso_lbls[idxs_over]:
+        slc               =  pad_slice(frags_feats.bbox_slice([lbl]), over_mtx.shape)                                # bounding box of the component, 1 voxel larger to contain its expansion
+        over_bff          =  (over_mtx[slc] == lbl)                                                                 # take the connected component form the over segmented matrix
+        over_bff          =  (expand_labels(over_bff) ^ over_bff) * over_mtx[slc]                                   # expand the component, take only the expansion and multiply it with the over_mtx
+        neighbours[lbl]   =  np.unique(over_bff[over_bff != 0])                                                     # check all the tags in the expansion (tags of the touching nuclei)
+
+    # Over segmented objects are fixed in their order. Fragments are only removed from over_mtx, so an object
+    # whose fragment and neighbours are not shared with any object before it cannot be influenced by them:
+    # such objects are fixed together in a wave, sharing the calls to the classifier.
+    pending  =  list(iso_lbls[idxs_over])
+    removed  =  set()                                                                                               # fragments already merged (removed from over_mtx)
+    while pending:
+        wave, blocked  =  [], set()
+        for lbl in pending:
+            closed  =  {lbl} | set(neighbours[lbl])
+            if not closed & blocked:
+                wave.append(lbl)
+            blocked  |=  closed
+
+        bff_idxs  =  [np.asarray([nb for nb in neighbours[lbl] if nb not in removed]) if lbl not in removed else np.zeros(0, dtype=int) for lbl in wave]   # fragments still touching each object
+        searches  =  [cnt for cnt in range(len(wave)) if bff_idxs[cnt].size > 1]                                   # objects touching several fragments: search the best union
+        merges    =  search_merges(frags_feats, over_mtx, [wave[cnt] for cnt in searches], [bff_idxs[cnt] for cnt in searches], model, size_max)       # pruned search, bounded to MAX_CANDIDATES possible nuclei
+        merges    =  dict(zip(searches, merges))
+
+        for cnt, lbl in enumerate(wave):
+            merged  =  [lbl]                                                                                        # fragments of the new nucleus: first the connected component with idx_over
+            if bff_idxs[cnt].size == 1:                                                                             # if there is 1 touching objetc  (if there are 0 objects, it means that the connected component is isolated, nothing to do about it, maybe the classifier made a mistake)
+                merged  +=  [bff_idxs[cnt][0]]                                                                      # add it to the nucleus
+            elif merges.get(cnt) is not None:                                                                       # a union recognized as a well segmented nucleus (the one with less connected components involved)
+                merged  =  merges[cnt]
+
+            if lbl not in removed:
+                slc             =  frags_feats.bbox_slice(merged)                                                   # the new nucleus is in the bounding box of its fragments
+                new_nuc                 =  np.isin(over_mtx[slc], merged)
+                nuc_fin[slc][new_nuc]   =  lbl                                                                      # the involved connected components become the reconstructed new nucleus in the final matrix
+                over_mtx[slc][new_nuc]  =  0                                                                        # remove the selected objects from the matrix of the over segmented
+                removed        |=  set(merged)
+
+        pending  =  [lbl for lbl in pending if lbl not in wave]
+
+    nuc_fin  =  label(nuc_fin)
+    return nuc_fin.astype(label_dtype(nuc_fin.max()))
+
+
+def segmentation_params(tiled):
+    """Parameters the segmented frames depend on, to identify them in the cache."""
+    return {"version": SEGMENTATION_VERSION, "tiled": bool(tiled), "max_candidates": MAX_CANDIDATES, "size_margin": SIZE_MARGIN, "peaks_footprint": PEAKS_FOOTPRINT.shape}
+
+
+def available_memory():
+    """Memory (bytes) available for new processes, None if it cannot be read on this system."""
+    try:
+        with open('/proc/meminfo') as f:
+            return int([line.split()[1] for line in f if line.startswith('MemAvailable:')][0]) * 1024
+    except (OSError, IndexError, ValueError):
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, OSError, ValueError):                               # no sysconf on Windows
+        return None
+
+
+def default_workers(frame_shape, dtype):
+    """Number of worker processes for frames of a shape and type: all the cores but one, as long as their segmentations fit in a fraction of the available memory."""
+    n_workers  =  max(1, multiprocessing.cpu_count() - 1)
+    memory     =  available_memory()
+    if memory is not None:
+        n_workers  =  min(n_workers, int(MEMORY_FRACTION * memory // (WORKER_FRAMES * np.prod(frame_shape) * np.dtype(dtype).itemsize)))
+    return max(1, n_workers)
+
+
+def init_worker(predict_jobs, clf_fname):
+    """Load the classifier once in each worker process."""
+    NucleiFeatures.load_classifier(clf_fname, n_jobs=predict_jobs)
+
+
+def segment_frame_worker(frame, tiled, clf_fname):
+    """Segment a frame in a worker process, with the classifier of the process; give back also labels, volumes, centroids and bounding boxes of the nuclei and the computation time."""
+    t_start  =  time.time()
+    nucs     =  segment_frame(frame, NucleiFeatures.load_classifier(clf_fname), tiled=tiled)
+    return nucs, NucleiFeatures.centroids_volumes(nucs), time.time() - t_start
 
 
 class NucleiSegmenter3D:
-    """Main class, does all the job."""
-    def __init__(self, nucs):
+    """Main class, does all the job.
 
-        model     =  joblib.load('finalized_model.sav')                                                                # import the pretrained classifier
-        nucs_sgm  =  np.zeros_like(nucs)
-        tlen      =  nucs.shape[0]
-        pbar      =  ServiceWidgets.ProgressBar(total1=tlen + 1)
+    With n_workers > 1 frames are segmented in parallel on a pool of processes, with at
+    most n_workers + 1 frames in flight (default_workers gives a number of workers whose
+    segmentations fit in memory); predict_jobs is the number of threads used by each classifier; with tiled the
+    watershed runs on each connected component separately. With use_cache segmented
+    frames are stored in (and read back from) the on disk segmentation cache: only
+    frames missing from it are segmented, so that a run interrupted or with failed frames
+    resumes where it stopped just launching it again. A frame whose segmentation fails is
+    left empty and recorded in failed_frames, the other frames go on.
+    """
+    def __init__(self, nucs, n_workers=1, predict_jobs=1, tiled=True, use_cache=True, cache_folder=SegmentationCache.CACHE_FOLDER, clf_fname='finalized_model.sav'):
+
+        nucs_sgm     =  np.zeros(nucs.shape, dtype=nucs.dtype)                                                      # nucs can be a lazy channel: do not convert it to array
+        tlen         =  nucs.shape[0]
+        frames_time  =  np.zeros(tlen)                                                                              # computation time of each frame (s), 0 for the frames read from the cache
+        pbar         =  ServiceWidgets.ProgressBar(total1=tlen + 1)
         pbar.update_progressbar1(1)
         pbar.show()
 
-        for tt in range(tlen):
-            pbar.update_progressbar1(tt + 1)
-            aa_g0       =  gaussian(nucs[tt], 2)                                                                            # smoothing with a gaussian filter
-            val1        =  threshold_otsu(aa_g0)                                                                            # threshold for detetction
-            aze1        =  aa_g0 > val1
-            nuc_lbls    =  label(aze1).astype(np.uint16)                                                                    # label connected components
-            distance    =  distance_transform_edt(nuc_lbls)                                                                 # distance matrix for watershed
-            local_maxi  =  peak_local_max(distance, footprint=np.ones((5, 11, 11)), labels=label(nuc_lbls))                 # find peaks of distance matrix
-            markers     =  np.zeros_like(nuc_lbls)
-            for k in local_maxi:
-                markers[k[0], k[1], k[2]]  =  1                                                                             # peaks in a 3D matrix
-            markers     =  label(markers)                                                                                   # label markers
-            nuc_fin     =  watershed(-distance, markers, mask=np.sign(nuc_lbls))                                            # watershed
-
-            rgp_tot  =  regionprops_table(nuc_fin, properties=["label", "solidity", "coords"])                              # regionprops of the segmtend nuclei
-            uus      =  np.where(np.isinf(rgp_tot["solidity"]))[0]                                                          # identify spots with infinitive solidity (clear errors in segmentation, non-3D objects)
-            for uu in uus:
-                bff_mtx  =  (expand_labels((nuc_fin == rgp_tot["label"][uu])) - (nuc_fin == rgp_tot["label"][uu]) * 1) * nuc_fin    # expand label of problematic detection
-                bff_idx  =  np.unique(bff_mtx[bff_mtx != 0])                                                                        # find the label of touching nuclei
-                if bff_idx.size > 0:
-                    nuc_fin[rgp_tot["coords"][uu][:, 0], rgp_tot["coords"][uu][:, 1], rgp_tot["coords"][uu][:, 2]]  =  bff_idx[0]  # change the label of the problematic component into the label of touching object (if more than one touching objects is present, just connect with the first -solidity infinitive objects are super small)
-
-            rgp_new              =  regionprops_table(nuc_fin, properties=["label", "coords"])                              # re-run regionprops on the corrected matrix
-            msk_brdr             =  np.zeros_like(nuc_fin)                                                                  # mask to identify all the nuclei touching the border
-            msk_brdr[:, :2, :]   =  1                                                                                       # put a border on the mask (2 pixels thick)
-            msk_brdr[:, -2:, :]  =  1
-            msk_brdr[:, :, :2]   =  1
-            msk_brdr[:, :, -2:]  =  1
-            idx_brd              =  msk_brdr * nuc_fin                                                                      # multiply mask and segmented nuclei retrive the label of touching nuclei
-            idx_brd              =  np.unique(idx_brd[idx_brd != 0])                                                        # retrive the labels of touching nuclei
-            for ee in idx_brd:
-                ee_idx  =  np.where(rgp_new["label"] == ee)[0][0]                                                           # remove nuclei touching the border
-                nuc_fin[rgp_new["coords"][ee_idx][:, 0], rgp_new["coords"][ee_idx][:, 1], rgp_new["coords"][ee_idx][:, 2]]  =  0            # use coords since it is faster
-
-            nuc_fin   =  label(nuc_fin)                                                                                      # re-label new segmented nuclei matrix
-            # nuc_fin2  =  np.copy(nuc_fin)
-            feat_bff  =  np.squeeze(np.asarray(list(regionprops_table(nuc_fin, properties=["label", "area", "area_bbox", "area_convex", "area_filled", "axis_major_length", "axis_minor_length",        # regionprops: takes directly the array of the values
-                                                                                           "equivalent_diameter_area", "extent", "feret_diameter_max", "inertia_tensor_eigvals", "solidity", "inertia_tensor"]).values()))).T
-            features   =  feat_bff[:, 1:]
-            iso_lbls   =  feat_bff[:, 0].astype(np.int64)
-            preds      =  model.predict(features)                                                                           # run the classifier (trained before) on the features matrix
-            idxs_over  =  np.where(preds == 1)[0]                                                                           # identify the over segmented nuclei (labeled 1)
-            over_mtx   =  np.zeros_like(nuc_fin)                                                                            # initialize the matrix of the over segmented nuclei
-            for mm in idxs_over:
-                over_mtx  +=  iso_lbls[mm] * (nuc_fin == iso_lbls[mm])                                                      # add the nuclei to the over segmented matrix
-            # over_mtx2  =  np.copy(over_mtx)
-            for idx_over in idxs_over:                                                                                      # for all the over segmentes obejects
-                # print(idx_over)
-                over_bff  =  (over_mtx == iso_lbls[idx_over])                                                               # take the connected component form the over segmented matrix
-                over_bff  =  (expand_labels(over_bff) ^ over_bff) * over_mtx                                                # expand the component, take only the expansion and multiply it with the over_mtx
-                bff_idxs  =  np.unique(over_bff[over_bff != 0])                                                             # check all the tags in the expansion (tags of the touching nuclei)
-                new_nuc   =  over_mtx == iso_lbls[idx_over]                                                                 # initialize the new nucleus matrix: add first the connected component with idx_over
-                if bff_idxs.size == 1:                                                                                      # if there is 1 touching objetc  (if there are 0 objects, it means that the connected component is isolated, nothing to do about it, maybe the classifier made a mistake)
-                    new_nuc  +=  (over_mtx == bff_idxs[0])                                                                    # add it to the nucleus
-                elif bff_idxs.size > 1:                                                                                     # in case of several objects touching the component
-                    # break
-                    combs          =  all_possible_subsets(bff_idxs.size)                                                   # all the possible combination of the indexes of touching objects
-                    new_nucs_test  =  []                                                                                    # it is possible to combine all the touching objects in several ways, so list of possible new nuclei
-                    for uu in combs:                                                                                        # for each of the possible combination
-                        new_nuc_bff  =  over_mtx == iso_lbls[idx_over]                                                      # start with the connected component idx_over
-                        for sub_uu in uu:                                                                                   # for all the indexes
-                            new_nuc_bff  +=  (over_mtx == bff_idxs[sub_uu])                                                 # build one of the possible nuclei
-                        new_nucs_test.append(new_nuc_bff)                                                                   # add to the list of possible nuclei
-                    features_bff  =  np.zeros((len(new_nucs_test), 22))                                                     # initialize features matrix
-                    for cnt, pp in enumerate(new_nucs_test):                                                                # for each of the possible nuclei measure features and add it in the matrix as before
-                        features_bff[cnt]  =  np.asarray(list(regionprops_table(pp * 1, properties=["area", "area_bbox", "area_convex", "area_filled", "axis_major_length", "axis_minor_length", "equivalent_diameter_area",
-                                                                                                    "extent", "feret_diameter_max", "inertia_tensor_eigvals", "solidity", "inertia_tensor"]).values())).T
-                    preds_bff  =  model.predict(features_bff)                                                               # use the trained model to make predictions on the possible nuclei
-
-                    if 0 in preds_bff:                                                                                      # check if there is at least 1 possbile nucleus that the trained model recognizes as a well segmented one.
-                        qq         =  np.where(preds_bff == 0)[0][-1]                                                       # if there is, take it (in case they are more than one, take the one with less connected components involved)
-                        new_nuc    =  new_nucs_test[qq]                                                                     # new nuc to add is the one selected before
-
-                nuc_fin   *=  (1 - new_nuc)                                                                                 # remove all the involved connected components froml the original matrix
-                over_mtx  *=  (1 - new_nuc)                                                                                 # remove the selected objects from the matrix of the over segmented
-                nuc_fin   +=  new_nuc * iso_lbls[idx_over]                                                                  # add the reconstructed new nucleus to the final matrix
-
-            nucs_sgm[tt]  =  label(nuc_fin)
+        if use_cache:
+            params    =  segmentation_params(tiled)
+            clf_hash  =  SegmentationCache.classifier_hash(clf_fname)
+
+        def read_frame(tt):
+            """Read (decode) a frame and its cache key; give back also the segmented frame if it is in the cache."""
+            frame  =  np.asarray(nucs[tt])
+            if not use_cache:
+                return frame, None, None
+            key     =  SegmentationCache.frame_key(frame, params, clf_hash)
+            cached  =  SegmentationCache.load_frame(key, cache_folder)
+            return frame, key, cached if cached is not None and cached.shape == frame.shape else None
+
+        def store(tt, key, nucs_tt, stats_tt=None):
+            """Write a segmented frame in the output and in the cache, with labels, volumes, centroids and bounding boxes of its nuclei."""
+            nucs_sgm[tt]    =  nucs_tt
+            nucs_stats[tt]  =  stats_tt if stats_tt is not None else NucleiFeatures.centroids_volumes(nucs_tt)
+            if use_cache:
+                SegmentationCache.save_frame(key, nucs_tt, cache_folder)
+
+        n_cached    =  0                                                                                            # frames read from the cache: only the missing ones are segmented
+        failed      =  dict()                                                                                       # time frame -> error message of the frames that could not be segmented (left empty)
+        nucs_stats  =  [None] * tlen                                                                                # labels, volumes, centroids and bounding boxes of the nuclei of each frame, given to the trackers
+        if n_workers <= 1:
+            model  =  None
+            for tt in range(tlen):
+                pbar.update_progressbar1(tt + 1)
+                frame, key, cached  =  read_frame(tt)
+                if cached is not None:
+                    nucs_sgm[tt]    =  cached
+                    nucs_stats[tt]  =  NucleiFeatures.centroids_volumes(cached)
+                    n_cached       +=  1
+                    continue
+                if model is None:
+                    model  =  NucleiFeatures.load_classifier(clf_fname, n_jobs=predict_jobs)                       # import the pretrained classifier (only the first time)
+                t_start          =  time.time()
+                try:
+                    store(tt, key, segment_frame(frame, model, multiprocessing.cpu_count(), tiled))
+                except Exception:                                                                                   # a single frame must not stop the segmentation of the whole movie
+                    traceback.print_exc()
+                    failed[tt]  =  traceback.format_exc()
+                frames_time[tt]  =  time.time() - t_start
+
+        else:
+            with ProcessPoolExecutor(n_workers, mp_context=multiprocessing.get_context("spawn"), initializer=init_worker, initargs=(predict_jobs, clf_fname)) as executor:
+                futures  =  dict()                                                                                  # future -> (time frame, cache key)
+                n_done   =  0
+                for tt in range(tlen):
+                    frame, key, cached  =  read_frame(tt)                                                          # frames are read (decoded) only when needed
+                    if cached is not None:
+                        nucs_sgm[tt]    =  cached
+                        nucs_stats[tt]  =  NucleiFeatures.centroids_volumes(cached)
+                        n_cached       +=  1
+                        n_done         +=  1
+                        pbar.update_progressbar1(n_done)
+                    else:
+                        futures[executor.submit(segment_frame_worker, frame, tiled, clf_fname)]  =  tt, key
+                    if len(futures) > n_workers or (tt == tlen - 1 and futures):                                   # frames in flight: one per worker plus one waiting, each frame in flight costs a worker peak of memory
+                        done, _  =  wait(futures, return_when=FIRST_COMPLETED if tt < tlen - 1 else ALL_COMPLETED)
+                        for future in done:
+                            tt_done, key_done              =  futures.pop(future)
+                            try:
+                                nucs_tt, stats_tt, frames_time[tt_done]  =  future.result()
+                                store(tt_done, key_done, nucs_tt, stats_tt)                                         # results go in their own slot, whatever the order of completion
+                            except Exception:
+                                traceback.print_exc()
+                                failed[tt_done]  =  traceback.format_exc()
+                            n_done                        +=  1
+                            pbar.update_progressbar1(n_done)
+
+        if use_cache and n_cached < tlen:
+            SegmentationCache.evict(SegmentationCache.CACHE_MAX_BYTES, cache_folder)
 
         pbar.close()
+        nucs_stats  =  [stats_tt if stats_tt is not None else NucleiFeatures.centroids_volumes(nucs_sgm[tt]) for tt, stats_tt in enumerate(nucs_stats)]     # failed frames are empty
 
-        self.nucs_sgm  =  nucs_sgm
+        self.nucs_sgm       =  nucs_sgm
+        self.nucs_stats     =  nucs_stats
+        self.frames_time    =  frames_time
+        self.n_cached       =  n_cached
+        self.failed_frames  =  failed
 
 
 
@@ -9,6 +9,7 @@ import sys
 import os.path
 import time
 import traceback
+import multiprocessing
 from importlib import reload
 from natsort import natsorted
 import numpy as np
@@ -17,10 +18,13 @@ from PyQt5.QtCore import Qt
 from PyQt5 import QtGui, QtWidgets, QtCore
 
 import LoadRawDataCzi
+import CziProbe
+import CziDecoder
 import NucleiSegmenter3D
 import Nuclei3dTracker
 import AnalysisSaver
 import AnalysisLoader
+import TrackTable
 import PopUpTool
 import ServiceWidgets
 
@@ -250,6 +254,8 @@ class MainWindow(QtWidgets.QMainWindow):
         self.frame_sgm                =  frame_sgm
         self.colors4map               =  colors4map
         self.flag_trck                =  False
+        self.tracks                   =  None                                  # table and index of the tracked nuclei
+        self.nucs_stats               =  None                                  # labels, volumes, centroids and bounding boxes of the segmented nuclei of each frame
         self.selectpop_flag_checkbox  =  selectpop_flag_checkbox
 
         self.setGeometry(800, 100, 700, 500)
@@ -354,10 +360,18 @@ class MainWindow(QtWidgets.QMainWindow):
         QtWidgets.QApplication.processEvents()
 
         try:
+            fnames  =  LoadRawDataCzi.load_order(self.fnames)                                # same order of the loading: the preview is the first file loaded
+            probe   =  CziProbe.CziProbe(fnames)
+            self.statusBar().showMessage(probe.summary())                                   # sizes and memory estimation before decoding anything
+            QtWidgets.QApplication.processEvents()
+            decoder            =  CziDecoder.CziDecoder(fnames[:1])
+            crop_roi, z_range  =  ServiceWidgets.CropSelector.getCrop(decoder.mip_preview(), probe.shapes[0][1])    # choose the region to load on the mip of the first frame
+            decoder.close()
             self.frame_sgm.clear()
             self.frame_raw_red.clear()
             self.frame_raw_green.clear()
-            self.raw_data       =  LoadRawDataCzi.LoadRawDataCzi(self.fnames)
+            self.raw_data       =  LoadRawDataCzi.LoadRawDataCzi(self.fnames, crop_roi=crop_roi, z_range=z_range)
+            self.crop_roi       =  self.raw_data.crop_roi
             self.frame_raw_red.setImage(self.raw_data.red[0, 0], autoRange=False, autoLevels=True)
             self.frame_raw_green.setImage(self.raw_data.green[0, 0], autoRange=False, autoLevels=True)
             self.pixsize_x_lbl.setText("pix size XY = " + str(np.round(self.raw_data.pix_size_xy, decimals=4)) + "µm;")
@@ -381,11 +395,16 @@ class MainWindow(QtWidgets.QMainWindow):
 
         try:
             self.frame_sgm.clear()
-            self.nucs_segm  =  NucleiSegmenter3D.NucleiSegmenter3D(self.raw_data.red).nucs_sgm
+            n_workers        =  int(np.load('segm_workers.npy')[0]) or NucleiSegmenter3D.default_workers(self.raw_data.red.shape[1:], self.raw_data.red.dtype)     # 0 in the settings: as many workers as the memory allows
+            segmenter        =  NucleiSegmenter3D.NucleiSegmenter3D(self.raw_data.red, n_workers=n_workers)
+            self.nucs_segm   =  segmenter.nucs_sgm
+            self.nucs_stats  =  segmenter.nucs_stats                                                                      # given to the tracker: the table of the tracked nuclei needs no voxel scan
+            self.statusBar().showMessage("Segmentation: {} frames from the cache, failed frames {}; slowest frame {} ({:.1f} s), mean {:.1f} s per frame".format(segmenter.n_cached, sorted(segmenter.failed_frames) or "none", segmenter.frames_time.argmax(), segmenter.frames_time.max(), segmenter.frames_time.mean()))      # failed frames are empty: segment again to retry them
             self.frame_sgm.setImage(self.nucs_segm[self.sld_time.value(), self.sld_zed.value()], autoRange=False)
             nucs_cmap  =  pg.ColorMap(np.linspace(0, 1, self.nucs_segm.max()), color=self.colors4map)
             self.frame_sgm.setColorMap(nucs_cmap)
             self.flag_trck  =  False
+            self.tracks     =  None
         except Exception:
             traceback.print_exc()
         self.ready_indicator()
@@ -399,7 +418,10 @@ class MainWindow(QtWidgets.QMainWindow):
         try:
             self.frame_sgm.clear()
             # self.nucs_trck  =  Nuclei3dTracker.Nuclei3dTracker(self.nucs_segm, self.dist_thr_value, self.raw_data.pix_size_xy, self.raw_data.pix_size_z).nucs_trck
-            self.nucs_trck  =  Nuclei3dTracker.NucleiOverlTracker(self.nucs_segm).nucs_trck
+            tracker         =  Nuclei3dTracker.NucleiOverlTracker(self.nucs_segm, n_threads=multiprocessing.cpu_count(), pix_size_XY=self.raw_data.pix_size_xy, pix_size_Z=self.raw_data.pix_size_z, stats=self.nucs_stats)     # an interrupted tracking of the same nuclei resumes from its last checkpoint
+            self.nucs_trck  =  tracker.nucs_trck
+            self.tracks     =  tracker.tracks_table, tracker.tracks_index
+            self.statusBar().showMessage("Tracking: failed frames {}".format(sorted(tracker.failed_frames) or "none"))
             self.frame_sgm.setImage(self.nucs_trck[self.sld_time.value(), self.sld_zed.value()], autoRange=False)
             nucs_cmap  =  pg.ColorMap(np.linspace(0, 1, self.nucs_trck.max()), color=self.colors4map)
             self.frame_sgm.setColorMap(nucs_cmap)
@@ -417,7 +439,7 @@ class MainWindow(QtWidgets.QMainWindow):
         QtWidgets.QApplication.processEvents()
         try:
             # AnalysisSaver.AnalysisSaver(self.nucs_segm, self.nucs_trck, self.raw_data, folder2write, self.dist_thr_value, self.chs_red_green, self.soft_version, self.fname4journal)
-            AnalysisSaver.AnalysisSaver(self.nucs_segm, self.nucs_trck, self.raw_data, folder2write, self.raw_data.chs_red_green, self.soft_version, self.fname4journal)
+            AnalysisSaver.AnalysisSaver(self.nucs_segm, self.nucs_trck, self.raw_data, folder2write, self.raw_data.chs_red_green, self.soft_version, self.fname4journal, self.tracks)
         except Exception:
             traceback.print_exc()
         self.ready_indicator()
@@ -440,6 +462,8 @@ class MainWindow(QtWidgets.QMainWindow):
         try:
             self.nucs_trck      =  np.load(analysis_folder + '/nucs_trck.npy')
             self.nucs_segm      =  np.load(analysis_folder + '/nucs_segm.npy')
+            self.nucs_stats     =  None                                                               # measured by the tracker, if tracking is launched again
+            self.tracks         =  TrackTable.load_table(analysis_folder)                             # None for older analysis
             # self.chs_red_green  =  np.load(analysis_folder + '/chs_red_green.npy')
             self.frame_sgm.clear()
             self.frame_sgm.setImage(self.nucs_trck[self.sld_time.value(), self.sld_zed.value()], autoRange=True, autoLevels=True)
@@ -453,7 +477,7 @@ class MainWindow(QtWidgets.QMainWindow):
             self.pixsize_x_lbl.setText("pix size XY = " + str(np.round(self.raw_data.pix_size_xy, decimals=4)) + "µm;")
             self.pixsize_z_lbl.setText("Z step = " + str(np.round(self.raw_data.pix_size_z, decimals=4)) + "µm;")
             self.time_step_lbl.setText("Time Step = " + str(np.round(self.raw_data.time_step_value, decimals=4)) + "s")
-            self.crop_roi  =  [0, 0, self.raw_data.red_mip.shape[1], self.raw_data.red_mip.shape[2]]
+            self.crop_roi  =  self.raw_data.crop_roi
             self.sld_time.setMaximum(self.raw_data.red.shape[0] - 1)
             self.sld_time.setValue(0)
             self.sld_zed.setMaximum(self.raw_data.red.shape[1] - 1)
@@ -501,6 +525,7 @@ class SettingsChanges(QtWidgets.QWidget):
         self.ksf_h         =  np.load('keys_size_factor.npy')[0]
         self.ksf_w         =  np.load('keys_size_factor.npy')[1]
         self.red_green_ch  =  np.load('red_green_ch.npy')
+        self.segm_workers  =  int(np.load('segm_workers.npy')[0])
 
         ksf_h_lbl  =  QtWidgets.QLabel("Keys Scale Factor W")
 
@@ -540,6 +565,14 @@ class SettingsChanges(QtWidgets.QWidget):
         green_ch_numb_combo.setCurrentIndex(self.red_green_ch[1])
         self.green_ch_numb_var(green_ch_numb_combo.currentText())
 
+        segm_workers_lbl  =  QtWidgets.QLabel("Segmentation workers")
+
+        segm_workers_edt  =  QtWidgets.QLineEdit(self)
+        segm_workers_edt.textChanged[str].connect(self.segm_workers_var)
+        segm_workers_edt.setToolTip("Sets the number of processes segmenting frames in parallel (0 for as many as the memory allows; each one needs about 15 times the size of a frame)")
+        segm_workers_edt.setFixedSize(int(self.ksf_h * 50), int(self.ksf_w * 25))
+        segm_workers_edt.setText(str(self.segm_workers))
+
         save_btn  =  QtWidgets.QPushButton("Save", self)
         save_btn.clicked.connect(self.save_vars)
         save_btn.setToolTip('Make default the choseen parameters')
@@ -569,6 +602,8 @@ class SettingsChanges(QtWidgets.QWidget):
         layout_grid.addWidget(red_ch_numb_combo, 2, 1)
         layout_grid.addWidget(green_ch_numb_lbl, 3, 0)
         layout_grid.addWidget(green_ch_numb_combo, 3, 1)
+        layout_grid.addWidget(segm_workers_lbl, 4, 0)
+        layout_grid.addWidget(segm_workers_edt, 4, 1)
 
         layout  =  QtWidgets.QVBoxLayout()
         layout.addLayout(layout_grid)
@@ -595,10 +630,15 @@ class SettingsChanges(QtWidgets.QWidget):
         """Set the green channel number."""
         self.green_ch_numb_value  =  int(text) - 1
 
+    def segm_workers_var(self, text):
+        """Set the number of segmentation workers (0 for automatic)."""
+        self.segm_workers  =  int(text) if text.strip().isdigit() else 0
+
     def save_vars(self):
         """Save new settings."""
         np.save('keys_size_factor.npy', [self.ksf_h, self.ksf_w])
         np.save('red_green_ch.npy', [self.red_ch_numb_value, self.green_ch_numb_value])
+        np.save('segm_workers.npy', [self.segm_workers])
 
     def close_(self):
         """Close the widget."""
@@ -638,6 +678,14 @@ class SpatialAnalysisTool(QtWidgets.QWidget):
         frame_lbl_box.addWidget(analysis_folder_lbl)
         frame_lbl_box.addWidget(frame_raw_3ch)
 
+        segm_workers_lbl  =  QtWidgets.QLabel("Segmentation workers")
+
+        segm_workers_edt  =  QtWidgets.QLineEdit(self)
+        segm_workers_edt.textChanged[str].connect(self.segm_workers_var)
+        segm_workers_edt.setToolTip("Sets the number of processes segmenting frames in parallel (0 for as many as the memory allows; each one needs about 15 times the size of a frame)")
+        segm_workers_edt.setFixedSize(int(self.ksf_h * 50), int(self.ksf_w * 25))
+        segm_workers_edt.setText(str(self.segm_workers))
+
         save_btn  =  QtWidgets.QPushButton("Save", self)
         save_btn.clicked.connect(self.save_spatial)
         save_btn.setToolTip("Save data spatially organized")
@@ -0,0 +1,95 @@
+"""This function manages an on disk cache of decoded raw data.
+
+Each raw data file decoded with a given channel selection is stored as .npy matrices
+(red, green, red_mip, green_mip) in a folder named after a hash of file path, size,
+modification time, channels and crop; matrices are given back memory-mapped, so reopening
+a file costs no decoding and no copy. The cache has a size cap: least recently used
+entries are removed when it is exceeded.
+"""
+
+
+import os
+import time
+import shutil
+import hashlib
+import numpy as np
+
+
+CACHE_FOLDER     =  os.path.join(os.path.expanduser("~"), ".NucleiTracker3D", "raw_data_cache")      # where cached data are written
+CACHE_MAX_BYTES  =  100 * 1024 ** 3                                                                      # size cap of the cache (bytes)
+MATRICES         =  ["red", "green", "red_mip", "green_mip"]                                             # matrices stored for each entry
+
+
+def entry_key(fname, chs_red_green, crop=None):
+    """Hash identifying a raw data file (path, size, modification time) decoded with a channel selection and a crop ([x0, y0, x1, y1, z0, z1])."""
+    stat  =  os.stat(fname)
+    key   =  "{}|{}|{}|{}|{}".format(os.path.abspath(fname), stat.st_size, stat.st_mtime_ns, int(chs_red_green[0]), int(chs_red_green[1]))
+    if crop is not None:
+        key  +=  "|" + ",".join(str(int(k)) for k in crop)
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def entry_folder(fname, chs_red_green, crop=None):
+    """Folder of the cache entry of a raw data file decoded with a channel selection and a crop."""
+    return os.path.join(CACHE_FOLDER, entry_key(fname, chs_red_green, crop))
+
+
+def entry_size(entry_folder):
+    """Size in bytes of a cache entry."""
+    return sum(os.path.getsize(os.path.join(entry_folder, fname)) for fname in os.listdir(entry_folder))
+
+
+def load_entry(fname, chs_red_green, crop=None):
+    """Return a dictionary with the memory-mapped matrices of a cached file, None if it is not in the cache."""
+    folder  =  entry_folder(fname, chs_red_green, crop)
+    if not os.path.isfile(os.path.join(folder, "complete")):                    # entries are marked complete only once fully written
+        return None
+    os.utime(folder)                                                            # the modification time of the folder is the last use time (for LRU eviction)
+    return {mtx_name: np.load(os.path.join(folder, mtx_name + ".npy"), mmap_mode="r") for mtx_name in MATRICES}
+
+
+def new_entry(fname, chs_red_green, shape, dtype, crop=None, keep=()):
+    """Allocate on disk the matrices of a new cache entry, to be filled and then closed with close_entry.
+
+    shape is the (t, z, x, y) shape of a channel. Entries whose folders are in keep (the ones in use) are never
+    evicted to make room: return None if the entry cannot fit in the cache without them.
+    """
+    nbytes  =  2 * np.dtype(dtype).itemsize * shape[0] * shape[2] * shape[3] * (shape[1] + 1)       # both channels and both mips
+    if nbytes > CACHE_MAX_BYTES or evict(CACHE_MAX_BYTES - nbytes, keep) > CACHE_MAX_BYTES - nbytes:
+        return None
+
+    folder  =  entry_folder(fname, chs_red_green, crop)
+    if os.path.isdir(folder):                                                   # leftovers of an interrupted writing
+        shutil.rmtree(folder)
+    os.makedirs(folder)
+    shapes  =  {"red": shape, "green": shape, "red_mip": (shape[0],) + tuple(shape[2:]), "green_mip": (shape[0],) + tuple(shape[2:])}
+    entry   =  {mtx_name: np.lib.format.open_memmap(os.path.join(folder, mtx_name + ".npy"), mode="w+", dtype=dtype, shape=tuple(int(k) for k in shapes[mtx_name])) for mtx_name in MATRICES}
+    entry["folder"]  =  folder
+    return entry
+
+
+def close_entry(entry):
+    """Flush the matrices of a new entry and mark it as complete."""
+    for mtx_name in MATRICES:
+        entry[mtx_name].flush()
+    with open(os.path.join(entry["folder"], "complete"), "w") as f:
+        f.write(time.strftime("%d%b%Y %H:%M:%S"))
+
+
+def evict(max_bytes=CACHE_MAX_BYTES, keep=()):
+    """Remove the least recently used entries, except the ones whose folders are in keep, until the cache size is below max_bytes; return the final cache size."""
+    if not os.path.isdir(CACHE_FOLDER):
+        return 0
+    keep        =  {os.path.abspath(folder) for folder in keep}
+    entries     =  [os.path.join(CACHE_FOLDER, name) for name in os.listdir(CACHE_FOLDER)]
+    entries     =  sorted([entry for entry in entries if os.path.isdir(entry)], key=os.path.getmtime)      # oldest first
+    sizes       =  [entry_size(entry) for entry in entries]
+    cache_size  =  sum(sizes)
+    for entry, size in zip(entries, sizes):
+        if cache_size <= max_bytes:
+            break
+        if os.path.abspath(entry) in keep:                                      # entries read or written by the current load
+            continue
+        shutil.rmtree(entry, ignore_errors=True)
+        cache_size  -=  size
+    return cache_size
@@ -0,0 +1,62 @@
+"""This function writes and reads back the checkpoints of long frame by frame runs.
+
+A run (tracking, for instance) is identified by its name, its parameters and a hash of
+each frame of its input: frames already computed are written periodically in a folder,
+with a state.json file storing the number of frames done, the state of the run needed to
+go on (label counter, reference frame, ...) and the frames that failed. Launching again
+the same run on the same input resumes it from the last checkpoint.
+"""
+
+
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+
+
+CHECKPOINTS_FOLDER  =  os.path.join(os.path.expanduser("~"), ".NucleiTracker3D", "checkpoints")        # where checkpoints are written
+
+
+def frames_hashes(mtx):
+    """Hash of the content of each frame of a movie (first axis is time)."""
+    return [hashlib.sha1(np.ascontiguousarray(frame).view(np.uint8).ravel()).hexdigest() for frame in mtx]
+
+
+class RunCheckpoint:
+    """Checkpoint of a run, read back from disk if it exists (frames_done is 0 otherwise)."""
+    def __init__(self, run_name, inputs_hashes, params, checkpoints_folder=CHECKPOINTS_FOLDER):
+
+        key     =  hashlib.sha1("{}|{}|{}".format(run_name, sorted(params.items()), "".join(inputs_hashes)).encode()).hexdigest()
+        folder  =  os.path.join(checkpoints_folder, run_name + "_" + key)
+
+        frames_done, state, failed  =  0, dict(), dict()
+        if os.path.isfile(os.path.join(folder, "state.json")):
+            with open(os.path.join(folder, "state.json")) as f:
+                saved  =  json.load(f)
+            frames_done  =  saved["frames_done"]
+            state        =  saved["state"]
+            failed       =  {int(tt): msg for tt, msg in saved["failed"].items()}       # json keys are strings
+
+        self.folder       =  folder
+        self.frames_done  =  frames_done                                                # frames [0, frames_done) are in the checkpoint
+        self.state        =  state
+        self.failed       =  failed                                                     # time frame -> error message
+
+    def load_frame(self, tt):
+        """Frame tt of the output, as it was at the checkpoint."""
+        return np.load(os.path.join(self.folder, "frame_{}.npy".format(tt)))
+
+    def save(self, mtx, frames_done, state, failed):
+        """Write the frames of mtx computed since the last checkpoint, then the state (renamed at the end: a checkpoint is never half written)."""
+        os.makedirs(self.folder, exist_ok=True)
+        for tt in range(self.frames_done, frames_done):
+            np.save(os.path.join(self.folder, "frame_{}.npy".format(tt)), mtx[tt])
+        with open(os.path.join(self.folder, "state.tmp.json"), "w") as f:
+            json.dump({"frames_done": int(frames_done), "state": state, "failed": {str(tt): msg for tt, msg in failed.items()}}, f)
+        os.replace(os.path.join(self.folder, "state.tmp.json"), os.path.join(self.folder, "state.json"))
+        self.frames_done  =  frames_done
+
+    def remove(self):
+        """Remove the checkpoint, once the run is over."""
+        shutil.rmtree(self.folder, ignore_errors=True)
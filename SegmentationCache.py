@@ -0,0 +1,71 @@
+"""This function manages an on disk cache of segmented frames.
+
+Each segmented frame is stored as a compressed .npz file named after a hash of the raw
+frame content, the segmentation parameters and the classifier file: a frame already
+segmented with the same parameters (also in a different movie, after a crop of the time
+range or after a crash) is read back instead of segmented again. The cache has a size
+cap: least recently used frames are removed when it is exceeded.
+"""
+
+
+import os
+import hashlib
+import numpy as np
+
+
+CACHE_FOLDER        =  os.path.join(os.path.expanduser("~"), ".NucleiTracker3D", "segmentation_cache")     # where segmented frames are written
+CACHE_MAX_BYTES     =  20 * 1024 ** 3                                                                       # size cap of the cache (bytes)
+CLASSIFIERS_HASHES  =  dict()                                                                            # (path, size, modification time) -> hash of the content of the classifier file
+
+
+def classifier_hash(fname):
+    """Hash of the content of a classifier file, computed only once per file version."""
+    stat  =  os.stat(fname)
+    key   =  (os.path.abspath(fname), stat.st_size, stat.st_mtime_ns)
+    if key not in CLASSIFIERS_HASHES:
+        with open(fname, "rb") as f:
+            CLASSIFIERS_HASHES[key]  =  hashlib.sha1(f.read()).hexdigest()
+    return CLASSIFIERS_HASHES[key]
+
+
+def frame_key(frame, params, clf_hash):
+    """Hash identifying a raw frame (content, shape and type) segmented with a dictionary of parameters and a classifier."""
+    frame  =  np.ascontiguousarray(frame)
+    sha    =  hashlib.sha1(frame.view(np.uint8).ravel())
+    sha.update("|{}|{}|{}|{}".format(frame.shape, frame.dtype.str, sorted(params.items()), clf_hash).encode())
+    return sha.hexdigest()
+
+
+def load_frame(key, cache_folder=CACHE_FOLDER):
+    """Return the segmented frame stored with key, None if it is not in the cache."""
+    fname  =  os.path.join(cache_folder, key + ".npz")
+    try:
+        with np.load(fname) as npz:
+            nucs  =  npz["nucs"]
+    except (OSError, KeyError, ValueError):                                     # missing or unreadable (interrupted writing): segment again
+        return None
+    os.utime(fname)                                                             # the modification time is the last use time (for LRU eviction)
+    return nucs
+
+
+def save_frame(key, nucs, cache_folder=CACHE_FOLDER):
+    """Store a segmented frame; the file is written under a temporary name and then renamed, so it is never read half written."""
+    os.makedirs(cache_folder, exist_ok=True)
+    fname_tmp  =  os.path.join(cache_folder, key + ".tmp.npz")
+    np.savez_compressed(fname_tmp, nucs=nucs)
+    os.replace(fname_tmp, os.path.join(cache_folder, key + ".npz"))
+
+
+def evict(max_bytes=CACHE_MAX_BYTES, cache_folder=CACHE_FOLDER):
+    """Remove the least recently used frames until the cache size is below max_bytes."""
+    if not os.path.isdir(cache_folder):
+        return
+    fnames      =  [os.path.join(cache_folder, name) for name in os.listdir(cache_folder) if name.endswith(".npz")]
+    fnames      =  sorted(fnames, key=os.path.getmtime)                        # oldest first
+    sizes       =  [os.path.getsize(fname) for fname in fnames]
+    cache_size  =  sum(sizes)
+    for fname, size in zip(fnames, sizes):
+        if cache_size <= max_bytes:
+            break
+        os.remove(fname)
+        cache_size  -=  size
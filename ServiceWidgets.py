@@ -3,6 +3,7 @@
 """
 
 import numpy as np
+import pyqtgraph as pg
 from PyQt5 import QtWidgets
 from PyQt5.QtCore import Qt
 
@@ -352,3 +353,98 @@ class InputScalar(QtWidgets.QDialog):
         result  =  dialog.exec_()
         flag    =  dialog.params()
         return flag
+
+
+class CropSelector(QtWidgets.QDialog):
+    """Popup tool to choose, on a mip preview, the x-y region and the z range to load."""
+    def __init__(self, preview, zlen, parent=None):
+        super().__init__(parent)
+
+        ksf_h  =  np.load('keys_size_factor.npy')[0]
+        ksf_w  =  np.load('keys_size_factor.npy')[1]
+
+        frame_preview  =  pg.ImageView(self)
+        frame_preview.ui.roiBtn.hide()
+        frame_preview.ui.menuBtn.hide()
+        frame_preview.setImage(preview)
+
+        roi_crop  =  pg.RectROI([0, 0], [preview.shape[0], preview.shape[1]], pen='r')
+        frame_preview.addItem(roi_crop)
+
+        z_start_lbl  =  QtWidgets.QLabel("Z start", self)
+        z_start_lbl.setFixedSize(int(ksf_h * 60), int(ksf_w * 25))
+
+        z_start_edt  =  QtWidgets.QLineEdit(str(0), self)
+        z_start_edt.setToolTip("First z plane to load")
+        z_start_edt.setFixedSize(int(ksf_h * 35), int(ksf_w * 22))
+        z_start_edt.textChanged[str].connect(self.z_start_var)
+
+        z_end_lbl  =  QtWidgets.QLabel("Z end", self)
+        z_end_lbl.setFixedSize(int(ksf_h * 60), int(ksf_w * 25))
+
+        z_end_edt  =  QtWidgets.QLineEdit(str(zlen), self)
+        z_end_edt.setToolTip("Last z plane to load (excluded)")
+        z_end_edt.setFixedSize(int(ksf_h * 35), int(ksf_w * 22))
+        z_end_edt.textChanged[str].connect(self.z_end_var)
+
+        input_close_btn  =  QtWidgets.QPushButton("Ok", self)
+        input_close_btn.clicked.connect(self.input_close)
+        input_close_btn.setToolTip('Load the selected region')
+        input_close_btn.setFixedSize(int(ksf_h * 50), int(ksf_w * 25))
+
+        z_box  =  QtWidgets.QHBoxLayout()
+        z_box.addWidget(z_start_lbl)
+        z_box.addWidget(z_start_edt)
+        z_box.addStretch()
+        z_box.addWidget(z_end_lbl)
+        z_box.addWidget(z_end_edt)
+        z_box.addStretch()
+        z_box.addWidget(input_close_btn)
+
+        layout  =  QtWidgets.QVBoxLayout()
+        layout.addWidget(frame_preview)
+        layout.addLayout(z_box)
+
+        self.roi_crop       =  roi_crop
+        self.preview_shape  =  preview.shape
+        self.zlen           =  zlen
+        self.z_start_value  =  0
+        self.z_end_value    =  zlen
+
+        self.setWindowModality(Qt.ApplicationModal)
+        self.setLayout(layout)
+        self.setGeometry(300, 300, 500, 500)
+        self.setWindowTitle("Crop Data")
+
+    def z_start_var(self, text):
+        """Input the first z plane."""
+        if text.strip().isdigit():                                              # keep the last valid value while typing
+            self.z_start_value  =  int(text)
+
+    def z_end_var(self, text):
+        """Input the last z plane."""
+        if text.strip().isdigit():
+            self.z_end_value  =  int(text)
+
+    def input_close(self):
+        """Close."""
+        self.close()
+
+    def params(self):
+        """Output the crop roi [x0, y0, x1, y1] and the z range [z0, z1], clipped to the data size and never empty (at least one pixel and one z plane)."""
+        x0, y0    =  self.roi_crop.pos()
+        xsz, ysz  =  self.roi_crop.size()
+        x1, y1    =  int(np.round(x0 + xsz)), int(np.round(y0 + ysz))
+        x0, y0    =  min(max(0, int(np.round(x0))), self.preview_shape[0] - 1), min(max(0, int(np.round(y0))), self.preview_shape[1] - 1)     # a roi dragged out of the preview keeps its closest pixel
+        x1, y1    =  max(min(self.preview_shape[0], x1), x0 + 1), max(min(self.preview_shape[1], y1), y0 + 1)
+        z0        =  min(max(0, self.z_start_value), self.zlen - 1)
+        z1        =  max(min(self.zlen, self.z_end_value), z0 + 1)
+        return [[x0, y0, x1, y1], [z0, z1]]
+
+    @staticmethod
+    def getCrop(preview, zlen, parent=None):
+        """Send the output."""
+        dialog  =  CropSelector(preview, zlen, parent)
+        result  =  dialog.exec_()
+        crop    =  dialog.params()
+        return crop
@@ -0,0 +1,106 @@
+"""This function builds the table of the tracked nuclei.
+
+The table has a row per detection (a tracked nucleus in a time frame), stored as a numpy
+structured array sorted by track and time: track label, time frame, segmentation label,
+centroid (µm), volume (voxels) and bounding box (voxels, [z0, x0, y0, z1, x1, y1]). An
+index gives the row range of each track, so per track queries do not touch voxel data.
+The table is filled from the per frame statistics of the segmenter and the track label of each
+segmented nucleus (stats_table), or measuring the tracked matrix (build_table), for tracks of
+older analysis. Table and index are saved in the analysis folder as tracks_table.npy and tracks_index.npy.
+"""
+
+
+import os.path
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from scipy.ndimage import find_objects
+
+
+TABLE_DTYPE  =  np.dtype([("track_id", np.int64), ("t", np.int32), ("label", np.int64), ("z", np.float64), ("x", np.float64), ("y", np.float64), ("volume", np.int64), ("bbox", np.int32, (6,))])
+INDEX_DTYPE  =  np.dtype([("track_id", np.int64), ("start", np.int64), ("stop", np.int64)])
+
+
+def frame_rows(trck_frame, segm_frame, tt, scale):
+    """Rows of the table of a single time frame; scale are the (z, x, y) pixel sizes."""
+    coords   =  np.nonzero(trck_frame)
+    vals     =  trck_frame[coords]
+    n_bins   =  int(trck_frame.max()) + 1
+    volumes  =  np.bincount(vals, minlength=n_bins)
+    ids      =  np.flatnonzero(volumes[1:]) + 1                                        # tracks present in the frame
+    lbls     =  np.zeros(n_bins, dtype=np.int64)                                        # track label -> segmentation label (one to one in a frame)
+    lbls[vals]  =  segm_frame[coords]
+    slices   =  find_objects(trck_frame)
+
+    rows              =  np.zeros(ids.size, dtype=TABLE_DTYPE)
+    rows["track_id"]  =  ids
+    rows["t"]         =  tt
+    rows["label"]     =  lbls[ids]
+    for name, crd, sc in zip(["z", "x", "y"], coords, scale):
+        rows[name]  =  np.bincount(vals, weights=crd, minlength=n_bins)[ids] / volumes[ids] * sc
+    rows["volume"]    =  volumes[ids]
+    rows["bbox"]      =  np.array([[ss.start for ss in slices[idx - 1]] + [ss.stop for ss in slices[idx - 1]] for idx in ids], dtype=np.int32).reshape(-1, 6)     # frames can be empty (failed frames)
+    return rows
+
+
+def build_table(nucs_trck, nucs_segm, pix_size_xy=1.0, pix_size_z=1.0, n_threads=1):
+    """Table (sorted by track and time) and index of the tracked nuclei; frames are measured on a pool of n_threads threads."""
+    scale  =  np.array([pix_size_z, pix_size_xy, pix_size_xy], dtype=float)
+    with ThreadPoolExecutor(n_threads) as executor:
+        return sort_table(list(executor.map(lambda tt: frame_rows(nucs_trck[tt], nucs_segm[tt], tt, scale), range(nucs_trck.shape[0]))))
+
+
+def stats_table(stats, tracks, pix_size_xy=1.0, pix_size_z=1.0):
+    """Table and index of the tracked nuclei without touching voxel data: stats are the (labels, volumes, centroids, bounding boxes) of the segmented nuclei of each frame (as given by the segmenter), tracks the track label of each of them (0 if it is not tracked)."""
+    scale        =  np.array([pix_size_z, pix_size_xy, pix_size_xy], dtype=float)
+    frames_rows  =  []
+    for tt, ((lbls, volumes, ctrs, bboxes), trks) in enumerate(zip(stats, tracks)):
+        tracked           =  trks != 0
+        rows              =  np.zeros(tracked.sum(), dtype=TABLE_DTYPE)
+        rows["track_id"]  =  trks[tracked]
+        rows["t"]         =  tt
+        rows["label"]     =  lbls[tracked]
+        for cnt, name in enumerate(["z", "x", "y"]):
+            rows[name]  =  ctrs[tracked, cnt] * scale[cnt]
+        rows["volume"]    =  volumes[tracked]
+        rows["bbox"]      =  bboxes[tracked]
+        frames_rows.append(rows)
+    return sort_table(frames_rows)
+
+
+def sort_table(frames_rows):
+    """Join the rows of all the frames in a table sorted by track and time, and give back also its index."""
+    table  =  np.concatenate([np.zeros(0, dtype=TABLE_DTYPE)] + frames_rows)
+    table  =  table[np.lexsort((table["t"], table["track_id"]))]
+    return table, table_index(table)
+
+
+def table_index(table):
+    """Index of a table sorted by track: row range [start, stop) of each track."""
+    ids, starts, counts  =  np.unique(table["track_id"], return_index=True, return_counts=True)
+    index                =  np.zeros(ids.size, dtype=INDEX_DTYPE)
+    index["track_id"]    =  ids
+    index["start"]       =  starts
+    index["stop"]        =  starts + counts
+    return index
+
+
+def track_rows(table, index, track_id):
+    """Rows of a single track, in time order (empty if the track does not exist)."""
+    jj  =  np.searchsorted(index["track_id"], track_id)
+    if jj == index.size or index["track_id"][jj] != track_id:
+        return table[:0]
+    return table[index["start"][jj]:index["stop"][jj]]
+
+
+def save_table(folder, table, index):
+    """Write table and index in the analysis folder."""
+    np.save(folder + '/tracks_table.npy', table)
+    np.save(folder + '/tracks_index.npy', index)
+
+
+def load_table(folder):
+    """Read table and index from an analysis folder; None if the analysis has no table (older analysis)."""
+    if not os.path.isfile(folder + '/tracks_table.npy'):
+        return None
+    table  =  np.load(folder + '/tracks_table.npy')
+    return table, np.load(folder + '/tracks_index.npy')
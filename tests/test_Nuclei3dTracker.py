@@ -0,0 +1,26 @@
+"""Tests of the nuclei trackers (they show progressbars: PyQt5 is needed)."""
+
+
+import os
+import numpy as np
+import pytest
+
+QtWidgets  =  pytest.importorskip("PyQt5.QtWidgets")
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")                                  # progressbars without a display
+APP        =  QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+
+import Nuclei3dTracker
+
+
+def test_overl_untracked_nucleus_does_not_take_a_track():
+    """A nucleus appearing in frame 1 overlaps the nucleus of frame 2 more than the tracked one: the track must go on anyway."""
+    nucs_segm                    =  np.zeros((3, 2, 10, 20), dtype=np.uint16)
+    nucs_segm[0, :, 2:8, 2:8]    =  1
+    nucs_segm[1, :, 2:8, 2:8]    =  1                                               # tracked nucleus
+    nucs_segm[1, :, 2:8, 8:14]   =  2                                               # new nucleus, not in a track
+    nucs_segm[2, :, 2:8, 5:14]   =  1                                               # overlaps both, the new one the most
+    tracker                      =  Nuclei3dTracker.NucleiOverlTracker(nucs_segm, use_checkpoint=False)
+    np.testing.assert_array_equal(np.unique(tracker.nucs_trck[1]), [0, 1])
+    np.testing.assert_array_equal(np.unique(tracker.nucs_trck[2]), [0, 1])
+    np.testing.assert_array_equal(tracker.tracks_index["track_id"], [1])
+    np.testing.assert_array_equal(tracker.tracks_table["t"], [0, 1, 2])
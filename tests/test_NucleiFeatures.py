@@ -0,0 +1,59 @@
+"""Tests of the features measured for the classifier."""
+
+
+import numpy as np
+from skimage.measure import regionprops_table
+
+import NucleiFeatures
+
+
+def labels_volume():
+    """Small label volume (z, x, y): an ellipsoid, a box, an L shaped object and a flat (one z plane) object; label 4 is missing."""
+    zz, xx, yy                                =  np.mgrid[:8, :30, :30]
+    lbls_mtx                                  =  np.zeros((8, 30, 30), dtype=np.int32)
+    lbls_mtx[((zz - 3) / 3) ** 2 + ((xx - 8) / 6) ** 2 + ((yy - 8) / 4) ** 2 <= 1]  =  1
+    lbls_mtx[1:6, 18:24, 3:9]                 =  2
+    lbls_mtx[2:5, 3:12, 18:21]                =  3
+    lbls_mtx[2:5, 9:12, 21:27]                =  3
+    lbls_mtx[6, 16:22, 16:25]                 =  5
+    return lbls_mtx
+
+
+def regionprops_features(lbls_mtx):
+    """Labels and features matrix of regionprops_table, columns in the order of FEATURES_NAMES."""
+    rgp  =  regionprops_table(lbls_mtx, properties=["label"] + NucleiFeatures.FEATURES_NAMES)
+    return rgp.pop("label"), np.column_stack(list(rgp.values()))
+
+
+def test_frame_features_matches_regionprops():
+    lbls_mtx        =  labels_volume()
+    lbls, features  =  NucleiFeatures.frame_features(lbls_mtx, n_threads=2)
+    assert features.shape == (4, 22)
+    np.testing.assert_array_equal(lbls, [1, 2, 3, 5])
+
+    rgp_lbls, rgp_feats  =  regionprops_features(lbls_mtx * (lbls_mtx != 5))              # regionprops cannot measure the feret diameter of flat objects
+    np.testing.assert_array_equal(rgp_lbls, lbls[:3])
+    np.testing.assert_allclose(features[:3], rgp_feats, rtol=1e-6, atol=1e-8)
+
+
+def test_frame_features_flat_object():
+    lbls_mtx        =  labels_volume()
+    lbls, features  =  NucleiFeatures.frame_features(lbls_mtx)
+    flat            =  features[lbls == 5][0]
+    feret_col       =  NucleiFeatures.FEATURES_NAMES.index("feret_diameter_max")
+    names           =  [name for name in NucleiFeatures.FEATURES_NAMES if name != "feret_diameter_max"]
+    rgp             =  regionprops_table((lbls_mtx == 5).astype(np.uint8), properties=names)
+    np.testing.assert_allclose(np.delete(flat, feret_col), np.concatenate([col for col in rgp.values()]), rtol=1e-6, atol=1e-8)      # also area_convex 0 and infinite solidity
+    assert np.isinf(flat[NucleiFeatures.FEATURES_NAMES.index("solidity") + 2])                # inertia_tensor_eigvals has 3 columns
+    plane  =  regionprops_table((lbls_mtx[6] == 5).astype(np.uint8), properties=["feret_diameter_max"])
+    np.testing.assert_allclose(flat[feret_col], plane["feret_diameter_max"])              # feret diameter of the flat object is the one of its plane
+
+
+def test_centroids_volumes_matches_regionprops():
+    lbls_mtx                     =  labels_volume()
+    lbls, volumes, ctrs, bboxes  =  NucleiFeatures.centroids_volumes(lbls_mtx)
+    rgp                          =  regionprops_table(lbls_mtx, properties=["label", "area", "centroid", "bbox"])
+    np.testing.assert_array_equal(lbls, rgp["label"])
+    np.testing.assert_array_equal(volumes, rgp["area"])
+    np.testing.assert_allclose(ctrs, np.column_stack([rgp["centroid-0"], rgp["centroid-1"], rgp["centroid-2"]]))
+    np.testing.assert_array_equal(bboxes, np.column_stack([rgp["bbox-{}".format(kk)] for kk in range(6)]))
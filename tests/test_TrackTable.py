@@ -0,0 +1,57 @@
+"""Tests of the table of the tracked nuclei."""
+
+
+import numpy as np
+from skimage.measure import regionprops_table
+
+import TrackTable
+import NucleiFeatures
+
+
+def tracked_movie():
+    """Small tracked movie (t, z, x, y) of two nuclei, with an empty last frame."""
+    nucs_segm                      =  np.zeros((3, 4, 20, 20), dtype=np.uint16)
+    nucs_segm[:2, 1:3, 2:6, 3:8]   =  1
+    nucs_segm[:2, 0:4, 10:15, 9:12]  =  2
+    nucs_trck                      =  np.zeros_like(nucs_segm)
+    nucs_trck[nucs_segm == 1]      =  5
+    nucs_trck[nucs_segm == 2]      =  3
+    return nucs_trck, nucs_segm
+
+
+def test_table_matches_regionprops():
+    nucs_trck, nucs_segm  =  tracked_movie()
+    table, index          =  TrackTable.build_table(nucs_trck, nucs_segm, pix_size_xy=0.2, pix_size_z=0.5)
+    assert list(index["track_id"]) == [3, 5]
+    for tt in range(2):
+        rgp   =  regionprops_table(nucs_trck[tt], properties=["label", "centroid", "area", "bbox"])
+        rows  =  table[table["t"] == tt]
+        rows  =  rows[np.argsort(rows["track_id"])]
+        np.testing.assert_array_equal(rows["track_id"], rgp["label"])
+        np.testing.assert_allclose(rows["z"], rgp["centroid-0"] * 0.5)
+        np.testing.assert_allclose(rows["x"], rgp["centroid-1"] * 0.2)
+        np.testing.assert_allclose(rows["y"], rgp["centroid-2"] * 0.2)
+        np.testing.assert_array_equal(rows["volume"], rgp["area"])
+        np.testing.assert_array_equal(rows["bbox"], np.column_stack([rgp["bbox-" + str(k)] for k in range(6)]))
+    np.testing.assert_array_equal(TrackTable.track_rows(table, index, 5)["label"], [1, 1])
+
+
+def test_empty_frame():
+    nucs_trck, nucs_segm  =  tracked_movie()
+    rows                  =  TrackTable.frame_rows(nucs_trck[2], nucs_segm[2], 2, np.ones(3))
+    assert rows.size == 0
+    table, index          =  TrackTable.build_table(nucs_trck, nucs_segm)
+    assert table.size == 4 and not np.any(table["t"] == 2)
+    assert TrackTable.track_rows(table, index, 7).size == 0
+
+
+def test_stats_table_matches_build_table():
+    nucs_trck, nucs_segm         =  tracked_movie()
+    nucs_segm[1, 0, 17:19, 1:3]  =  4                                                   # a nucleus not linked to any track
+    stats                        =  [NucleiFeatures.centroids_volumes(frame) for frame in nucs_segm]
+    tags                         =  np.array([0, 5, 3, 0, 0])                         # segmented label -> track label
+    table, index                 =  TrackTable.stats_table(stats, [tags[stat[0]] for stat in stats], pix_size_xy=0.2, pix_size_z=0.5)
+    table_vxl, index_vxl         =  TrackTable.build_table(nucs_trck, nucs_segm, pix_size_xy=0.2, pix_size_z=0.5)
+    np.testing.assert_array_equal(index, index_vxl)
+    for name in TrackTable.TABLE_DTYPE.names:
+        np.testing.assert_allclose(table[name], table_vxl[name])